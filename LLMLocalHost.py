@@ -1,9 +1,18 @@
 import llmgraphbuilder
+import metrics
+import shutil
 import socket
-from flask import Flask, request, jsonify
+import sys
+import os
+import gc
+import json
+import logging
+import threading
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import subprocess
 import random
+from tracing import tracer
 
 def get_local_ip():
     """Find the local network IP of this machine."""
@@ -16,17 +25,205 @@ def get_local_ip():
         s.close()
     return ip
 
+def parse_payload(data):
+    """Accept either a bare question or {"question": ..., "session_id": ...}."""
+    if isinstance(data, dict):
+        session_id = data.get("session_id")
+        return data.get("question"), str(session_id) if session_id is not None else None
+    return data, None
+
 app = Flask(__name__)
 
+# --- Readiness ---
+# Liveness only says the process serves HTTP; readiness turns green once the
+# graph is compiled and a warm-up question has gone through the whole workflow.
+WARMUP_QUESTION = os.environ.get("WARMUP_QUESTION", "Hello")
+WARMUP_SESSION = "__warmup__"
+server_state = {"ready": False}
+
+def warm_up():
+    llmgraphbuilder.get_vector_store()
+    workflow = llmgraphbuilder.get_workflow()
+    workflow.ask_question(WARMUP_QUESTION, session_id=WARMUP_SESSION)
+    workflow.clear_memory(WARMUP_SESSION)
+    server_state["ready"] = True
+
+def warm_up_in_background():
+    # Liveness is served meanwhile; /readyz stays 503 until warm-up succeeds
+    def run():
+        try:
+            warm_up()
+        except Exception as e:
+            tracer.emit(logging.ERROR, "warm_up_failed", error=repr(e))
+    threading.Thread(target=run, daemon=True, name="warm-up").start()
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "alive"})
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    if server_state["ready"]:
+        return jsonify({"status": "ready"})
+    return jsonify({"status": "warming up"}), 503
+
+# --- Metrics ---
+# Prometheus text format: per-node and per-node-type latency histograms, embedding /
+# FAISS / LLM / memory sub-phases, prompt and response sizes and cache hit counts.
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(llmgraphbuilder.script_dir, "metrics_data"))
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route("/run", methods=["POST"])
 def run():
-    data = request.json
-    result = llmgraphbuilder.prompt(data)
+    question, session_id = parse_payload(request.json)
+    result = llmgraphbuilder.prompt(question, session_id=session_id)
     return jsonify({"result": result})
     #c=random.randint(0,2000)
     #return jsonify("Babbaboi" + str(data))
 
+@app.route("/run_stream", methods=["POST"])
+def run_stream():
+    # Server-sent events: "token" events while the answer is generated, then a
+    # final "answer" (or "error") event carrying the complete result.
+    question, session_id = parse_payload(request.json)
+
+    def events():
+        for event, payload in llmgraphbuilder.prompt_stream(question, session_id=session_id):
+            yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/run_batch", methods=["POST"])
+def run_batch():
+    # Body: a JSON list of /run payloads, or newline-delimited JSON (one payload per
+    # line) with Content-Type application/x-ndjson. NDJSON input or ?stream=1 streams
+    # {"index", "result"} lines as chunks finish; otherwise one JSON list is returned.
+    if request.mimetype == "application/x-ndjson":
+        items = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        stream = True
+    else:
+        items = request.json
+        stream = request.args.get("stream", "0") not in ("0", "false", "")
+    if not isinstance(items, list):
+        return jsonify({"error": "expected a list of questions"}), 400
+    parsed = [parse_payload(item) for item in items]
+    questions = [question for question, _ in parsed]
+    session_ids = [session_id for _, session_id in parsed]
+    results = llmgraphbuilder.prompt_batch(questions, session_ids=session_ids)
+
+    if not stream:
+        answers = [None] * len(questions)
+        for index, answer in results:
+            answers[index] = answer
+        return jsonify({"results": answers})
+
+    def lines():
+        for index, answer in results:
+            yield json.dumps({"index": index, "result": answer}) + "\n"
+
+    return Response(stream_with_context(lines()), mimetype="application/x-ndjson")
+
+# --- ASGI entry point ---
+# Same /run route for an ASGI server (e.g. `uvicorn LLMLocalHost:asgi_app`):
+# questions are awaited on one event loop instead of holding a thread each.
+async def _send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                warm_up_in_background()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    if scope['path'] == '/healthz':
+        await _send_json(send, 200, {"status": "alive"})
+        return
+    if scope['path'] == '/readyz':
+        if server_state["ready"]:
+            await _send_json(send, 200, {"status": "ready"})
+        else:
+            await _send_json(send, 503, {"status": "warming up"})
+        return
+    if scope['path'] == '/metrics':
+        body = metrics.registry.render().encode('utf-8')
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', METRICS_CONTENT_TYPE.encode()),
+                                (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+        return
+    if scope['path'] != '/run':
+        await _send_json(send, 404, {"error": "not found"})
+        return
+    if scope['method'] != 'POST':
+        await _send_json(send, 405, {"error": "method not allowed"})
+        return
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    question, session_id = parse_payload(json.loads(body) if body else None)
+    result = await llmgraphbuilder.prompt_async(question, session_id=session_id)
+    await _send_json(send, 200, {"result": result})
+
+# --- Production Server ---
+def serve_production(host: str = "0.0.0.0", port: int = 5000, workers: int = None, threads: int = 8):
+    """Pre-forking gunicorn server sharing one warmed-up index and compiled graph.
+
+    The FAISS index is loaded and the graph compiled by warm_up() in the parent; gc.freeze() then moves those objects out of the collector's reach so
+    forked workers keep sharing their pages copy-on-write. Each worker reopens
+    its own network clients after fork. Workers share their metrics through
+    METRICS_DIR so a scrape of any worker reports the whole server.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    warm_up()
+    gc.freeze()
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+
+    def post_fork(server, worker):
+        llmgraphbuilder.reinit_clients()
+        metrics.registry.enable_multiprocess(METRICS_DIR)
+
+    class ProductionApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers or os.cpu_count() or 1)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            return app
+
+    ProductionApplication().run()
+
 if __name__ == "__main__":
     local_ip = get_local_ip()
     print(f"Server running at: http://{local_ip}:5000/run")
-    app.run(host="0.0.0.0", port=5000)
+    if "--production" in sys.argv:
+        serve_production()
+    elif "--async" in sys.argv:
+        import uvicorn
+        # Warmed up by the lifespan startup, like any `uvicorn LLMLocalHost:asgi_app`
+        uvicorn.run(asgi_app, host="0.0.0.0", port=5000)
+    else:
+        llmgraphbuilder.get_workflow()
+        server_state["ready"] = True
+        app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Modules whose presence after `import llmgraphbuilder` means something heavy
+# (model clients, FAISS, numpy) is being loaded eagerly again.
+HEAVY_PREFIXES = ("langchain", "langchain_core", "langchain_community", "langchain_google_genai",
+                  "faiss", "numpy", "google", "transformers", "torch")
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import llmgraphbuilder
+from llmgraphbuilder import Graph, Node, Connection, LLMWorkflow
+elapsed = time.perf_counter() - start
+heavy = sorted({m.split('.')[0] for m in sys.modules if m.split('.')[0] in %r})
+print(json.dumps({"elapsed": elapsed, "heavy": heavy}))
+""" % (HEAVY_PREFIXES,)
+
+
+def measure(runs: int):
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for _ in range(runs):
+        # A fresh interpreter per run so nothing is already in sys.modules
+        out = subprocess.run([sys.executable, "-c", PROBE], cwd=script_dir, capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of llmgraphbuilder.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.2, help="maximum median import time in seconds")
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    times = [r["elapsed"] for r in results]
+    heavy = sorted({m for r in results for m in r["heavy"]})
+    median = statistics.median(times)
+    print(f"import llmgraphbuilder: median {median * 1000:.1f} ms, min {min(times) * 1000:.1f} ms, "
+          f"max {max(times) * 1000:.1f} ms over {args.runs} runs")
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy modules imported eagerly: {', '.join(heavy)}")
+        failed = True
+    if median > args.budget:
+        print(f"FAIL: median import time exceeds budget of {args.budget * 1000:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
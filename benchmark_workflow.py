@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+from llmgraphbuilder import Graph, LLMWorkflow, file_path
+from memorystore import MemoryStore
+import tracing
+from promptbudget import get_tokenizer
+from fakemodels import FakeChatModel, HashingEmbeddings, local_vector_store
+
+# --- Generated Graphs ---
+def wide_graph(width: int, node_type: str = 'query', content=None, options=()) -> Graph:
+    # Nodes get distinct content (followed by options) unless content is given,
+    # so the graph optimizer does not merge them into one
+    graph = Graph()
+    inp = graph.add_node('input')
+    out = graph.add_node('output')
+    for i in range(width):
+        default = ([f"Answer {i}: "] if node_type == 'query' else [f"Source {i}"]) + list(options)
+        node = graph.add_node(node_type, list(content) if content else default)
+        graph.add_connection(inp, node)
+        graph.add_connection(node, out)
+    return graph
+
+
+def deep_graph(depth: int) -> Graph:
+    graph = Graph()
+    prev = graph.add_node('input')
+    for _ in range(depth):
+        node = graph.add_node('query', ["Refine: "])
+        graph.add_connection(prev, node)
+        prev = node
+    graph.add_connection(prev, graph.add_node('output'))
+    return graph
+
+
+def layered_graph(width: int, depth: int, fan_in: int = 2, memory_window=("4", "1000")) -> Graph:
+    # Each layer cycles retrieval -> query -> memory nodes, each fed by fan_in nodes of the
+    # previous layer. Memory nodes feeding memory nodes re-append whole histories, so keep
+    # them windowed in tokens as well: with entries only, the text handed down grows
+    # geometrically with depth across asks.
+    types = ('retrieval', 'query', 'memory')
+    graph = Graph()
+    inp = graph.add_node('input')
+    layer = [inp]
+    for d in range(depth):
+        next_layer = []
+        for w in range(width):
+            node_type = types[(d + w) % len(types)]
+            content = ["Combine: "] if node_type == 'query' else (list(memory_window) if node_type == 'memory' else [])
+            node = graph.add_node(node_type, content)
+            for i in range(min(fan_in, len(layer))):
+                graph.add_connection(layer[(w + i) % len(layer)], node)
+            next_layer.append(node)
+        layer = next_layer
+    out = graph.add_node('output')
+    for prev in layer:
+        graph.add_connection(prev, out)
+    return graph
+
+
+def condition_graph(fanout: int, trigger: str = "w", options: str = "") -> Graph:
+    # input -> query -> condition routing to `fanout` query nodes per branch
+    graph = Graph()
+    inp = graph.add_node('input')
+    first = graph.add_node('query', ["Classify: "])
+    graph.add_connection(inp, first)
+    cond = graph.add_node('condition', [trigger, options] if options else [trigger])
+    graph.add_connection(first, cond)
+    out = graph.add_node('output')
+    for branch in ("true", "false"):
+        for i in range(fanout):
+            node = graph.add_node('query', [f"{branch} branch {i}: "])
+            graph.add_connection(cond, node, branch)
+            graph.add_connection(inp, node)
+            graph.add_connection(node, out)
+    return graph
+
+
+def memory_graph(memory_window=None, token_budget: str = "") -> Graph:
+    graph = Graph()
+    inp = graph.add_node('input')
+    memory = graph.add_node('memory', list(memory_window) if memory_window else [])
+    query = graph.add_node('query', ["With history: ", token_budget] if token_budget else ["With history: "])
+    graph.add_connection(inp, memory)
+    graph.add_connection(memory, query)
+    graph.add_connection(inp, query)
+    graph.add_connection(query, graph.add_node('output'))
+    return graph
+
+
+# name -> (graph factory, memory entries pre-filled per memory node)
+SCENARIOS = {
+    "wide-query-4": (lambda: wide_graph(4), 0),
+    "wide-query-32": (lambda: wide_graph(32), 0),
+    "wide-retrieval-16": (lambda: wide_graph(16, 'retrieval'), 0),
+    # Identical nodes: all but one are merged by common-node elimination
+    "cse-duplicates-16": (lambda: wide_graph(16, content=["Answer: "]), 0),
+    "wide-lexical-16": (lambda: wide_graph(16, 'retrieval', options=("lexical",)), 0),
+    "wide-fused-16": (lambda: wide_graph(16, 'retrieval', options=("fused",)), 0),
+    "deep-16": (lambda: deep_graph(16), 0),
+    "deep-128": (lambda: deep_graph(128), 0),
+    "layered-8x8": (lambda: layered_graph(8, 8), 10),
+    "layered-32x16": (lambda: layered_graph(32, 16), 10),
+    "condition-fanout-4": (lambda: condition_graph(4), 0),
+    "condition-fanout-32": (lambda: condition_graph(32), 0),
+    "condition-triggers-256": (lambda: condition_graph(4, "\n".join(f"keyword{i}" for i in range(256)),
+                                                       "all ignorecase word"), 0),
+    "memory-1k": (lambda: memory_graph(), 1000),
+    "memory-20k": (lambda: memory_graph(), 20000),
+    "memory-20k-window-50": (lambda: memory_graph(("50", "")), 20000),
+    "memory-20k-budget-2k": (lambda: memory_graph(token_budget="2000"), 20000),
+}
+
+
+# --- Measurement ---
+def run_scenario(name, factory, memory_entries, vector_store, llm, runs: int, batch_size: int, max_workers: int,
+                 tokenizer=None):
+    with tempfile.TemporaryDirectory() as tmp:
+        store = MemoryStore(tmp)
+        for node in factory().nodes:
+            if node.type == 'memory':
+                for i in range(memory_entries):
+                    store.append(node.id, f"earlier turn {i} with a few words of history")
+        store.flush()
+
+        build_times = []
+        workflow = None
+        for _ in range(runs):
+            workflow = LLMWorkflow(factory(), vector_store, llm, max_workers=max_workers, memory_store=store,
+                                   tokenizer=tokenizer)
+            start = time.perf_counter()
+            workflow.build()
+            build_times.append(time.perf_counter() - start)
+
+        ask_times = []
+        for i in range(runs):
+            start = time.perf_counter()
+            workflow.ask_question(f"benchmark question {i}")
+            ask_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        workflow.ask_questions([f"batch question {i}" for i in range(batch_size)])
+        batch_time = time.perf_counter() - start
+
+        tracemalloc.start()
+        workflow.ask_question("peak memory question")
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "name": name,
+        "nodes": len(workflow.graph.nodes),
+        "connections": len(workflow.graph.connections),
+        "build_ms": statistics.median(build_times) * 1000,
+        "ask_ms": statistics.median(ask_times) * 1000,
+        "ask_max_ms": max(ask_times) * 1000,
+        "batch_ms_per_question": batch_time * 1000 / batch_size,
+        "peak_kib": peak / 1024,
+    }
+
+
+def compare(results, baseline, tolerance: float):
+    regressions = []
+    previous = {r["name"]: r for r in baseline}
+    for r in results:
+        old = previous.get(r["name"])
+        if old is None:
+            continue
+        for metric in ("build_ms", "ask_ms", "batch_ms_per_question", "peak_kib"):
+            if old[metric] > 0 and r[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{r['name']}: {metric} {old[metric]:.2f} -> {r[metric]:.2f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LLMWorkflow build/ask with offline models.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="run only these scenarios")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds per fake LLM call")
+    parser.add_argument("--output-words", type=int, default=32, help="words per fake LLM reply")
+    parser.add_argument("--index-chunks", type=int, default=2000, help="chunks of Documentation.txt to index")
+    parser.add_argument("--tokenizer", help="tokenizer for prompt budgets (default: PROMPT_TOKENIZER)")
+    parser.add_argument("--trace-level", default="WARNING", help="workflow trace level while measuring")
+    parser.add_argument("--trace-sample-rate", type=float, default=1.0)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="results file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown vs baseline")
+    args = parser.parse_args()
+
+    # Offline run: never ship benchmark traces to LangSmith
+    os.environ["LANGSMITH_TRACING"] = "false"
+    tracing.configure(level=args.trace_level, sample_rate=args.trace_sample_rate, stream=sys.stderr)
+    llm = FakeChatModel(latency=args.llm_latency, output_words=args.output_words)
+    vector_store = local_vector_store(file_path, HashingEmbeddings(), max_chunks=args.index_chunks)
+    tokenizer = get_tokenizer(args.tokenizer)
+
+    results = []
+    print(f"{'scenario':<24}{'nodes':>7}{'build ms':>11}{'ask ms':>10}{'ask max':>10}{'batch/q ms':>12}{'peak KiB':>11}")
+    for name in args.scenario or SCENARIOS:
+        factory, memory_entries = SCENARIOS[name]
+        r = run_scenario(name, factory, memory_entries, vector_store, llm, args.runs, args.batch_size, args.max_workers,
+                         tokenizer)
+        results.append(r)
+        print(f"{name:<24}{r['nodes']:>7}{r['build_ms']:>11.2f}{r['ask_ms']:>10.2f}{r['ask_max_ms']:>10.2f}"
+              f"{r['batch_ms_per_question']:>12.2f}{r['peak_kib']:>11.1f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import re
+from typing import List, Optional
+
+# --- Condition Matching ---
+# A condition node's content is [triggers, options]: one trigger per line, and
+# options separated by commas or spaces:
+#   any (default) / all   take the "true" branch when any / every trigger occurs
+#   ignorecase            ignore letter case
+#   word                  only match whole words: no letter, digit or underscore
+#                         directly before or after the trigger
+#   regex                 triggers are regular expressions instead of plain text
+# Content with only the trigger field keeps its old meaning: the whole field is
+# one case-sensitive substring, newlines included, and an empty trigger always
+# matches. So does content that is not [triggers, options] (older nodes could
+# hold a dropped file as a second field). Lines are split into triggers only
+# when the options field is there, and no trigger at all always matches.
+# All triggers are compiled into one pattern when the graph is built, so routing
+# is a single scan of the input whatever the number of triggers.
+
+OPTIONS = ("any", "all", "ignorecase", "word", "regex")
+
+
+def match_options(content: List[str]) -> Optional[List[str]]:
+    """Options of condition content laid out as [triggers, options], else None."""
+    if len(content) > 2:
+        return None
+    options = content[1].strip().lower() if len(content) > 1 and content[1] else ""
+    options = re.split(r"[\s,]+", options) if options else []
+    if any(option not in OPTIONS for option in options):
+        return None
+    return options
+
+
+def trie_pattern(words: List[str]) -> str:
+    """Regex matching any of words, factored by common prefixes.
+
+    The regex engine then follows a single trie path at each text position
+    instead of trying every word in turn.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node: dict) -> str:
+        alternatives = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not alternatives:
+            return ""
+        body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        # A word ending here makes the longer continuations optional
+        return f"(?:{body})?" if "" in node else body
+
+    return emit(trie)
+
+
+class ConditionMatcher:
+    def __init__(self, triggers: List[str], match_all: bool = False, ignorecase: bool = False,
+                 word: bool = False, regex: bool = False):
+        self.triggers = [t for t in triggers if t]
+        self.match_all = match_all
+        self.always = not self.triggers
+        if self.always:
+            return
+        # Plain triggers are matched against lowercased text, which keeps the
+        # regex engine's fast scan for their first characters
+        self.lower = ignorecase and not regex
+        flags = re.IGNORECASE if ignorecase and regex else 0
+        if regex:
+            parts = [f"(?:{t})" for t in self.triggers]
+            any_part = "|".join(parts)
+        else:
+            words = [t.lower() for t in self.triggers] if self.lower else self.triggers
+            parts = [re.escape(t) for t in words]
+            any_part = trie_pattern(words)
+        # Word boundaries wrap the whole alternation rather than each trigger
+        before, after = (r"(?<!\w)", r"(?!\w)") if word else ("", "")
+        if match_all:
+            # Stop at every position where some trigger starts (zero-width, so
+            # overlapping triggers are all seen), then record each trigger
+            # that matches there in its own optional group
+            pattern = f"{before}(?=(?:{any_part}){after})" + "".join(
+                f"(?:(?=(?P<_t{i}>{part}){after}))?" for i, part in enumerate(parts))
+        else:
+            pattern = f"{before}(?:{any_part}){after}"
+        try:
+            self.pattern = re.compile(pattern, flags)
+        except re.error as e:
+            raise ValueError(f"invalid trigger pattern: {e}") from e
+        if match_all:
+            self._positions = [self.pattern.groupindex[f"_t{i}"] - 1 for i in range(len(parts))]
+
+    @classmethod
+    def from_content(cls, content: List[str]) -> "ConditionMatcher":
+        if not content:
+            raise ValueError("no trigger")
+        options = match_options(content)
+        if options is None or len(content) < 2:
+            return cls([content[0] or ""])
+        triggers = content[0].splitlines() if content[0] else []
+        if "any" in options and "all" in options:
+            raise ValueError("options 'any' and 'all' exclude each other")
+        return cls(triggers, match_all="all" in options, ignorecase="ignorecase" in options,
+                   word="word" in options, regex="regex" in options)
+
+    def matches(self, text: str) -> bool:
+        if self.always:
+            return True
+        if self.lower:
+            text = text.lower()
+        if not self.match_all:
+            return self.pattern.search(text) is not None
+        missing = self._positions
+        for m in self.pattern.finditer(text):
+            groups = m.groups()
+            missing = [p for p in missing if groups[p] is None]
+            if not missing:
+                return True
+        return False
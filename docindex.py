@@ -0,0 +1,445 @@
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import itertools
+import logging
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from llmcache import LRUCache, SQLiteStore, model_name_of
+from tracing import tracer
+
+# --- Load or Build FAISS Index ---
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 100
+
+def load_index(index_dir: str, embeddings: Embeddings) -> FAISS:
+    return FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+
+
+def load_or_build_index(index_dir: str, source_path: str, embeddings: Embeddings,
+                        on_rebuild: Optional[Callable[[], None]] = None, **build_options) -> FAISS:
+    if os.path.exists(index_dir):
+        return load_index(index_dir, embeddings)
+    vector_store = build_index(source_path, index_dir, embeddings, **build_options)
+    if on_rebuild is not None:
+        on_rebuild()
+    return vector_store
+
+# --- Indexing Pipeline ---
+def iter_chunks(source_path: str, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                block_chars: int = 256 * 1024):
+    """Yield Document chunks of source_path without reading the whole file.
+
+    The text is split one block at a time. Chunks ending within chunk_size of the
+    block edge are held back and re-split with the next block, so no chunk is cut
+    at a block boundary and start_index stays an absolute character offset.
+    """
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                              add_start_index=True)
+    buf = ""
+    buf_start = 0
+    with open(source_path, 'r', encoding='utf-8') as f:
+        while True:
+            block = f.read(block_chars)
+            eof = not block
+            buf += block
+            if not buf:
+                return
+            limit = len(buf) if eof else len(buf) - chunk_size
+            carry = len(buf)
+            for doc in splitter.create_documents([buf]):
+                start = doc.metadata['start_index']
+                if start + len(doc.page_content) > limit:
+                    carry = start
+                    break
+                doc.metadata['start_index'] = buf_start + start
+                yield doc
+            if eof:
+                return
+            buf = buf[carry:]
+            buf_start += carry
+
+
+def _batched(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _file_fingerprint(path: str) -> dict:
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _write_json_atomic(path: str, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def replace_dir(src: str, dst: str):
+    # Swap a freshly written directory into place; readers never see a half-written
+    # index, but dst is briefly missing between the two renames
+    old = dst + ".old"
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    if os.path.exists(dst):
+        os.replace(dst, old)
+    os.replace(src, dst)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+
+
+class _Checkpoint:
+    """Append-only progress log for build_index in <index_dir>.partial.
+
+    chunks.jsonl holds one {text, metadata} line per embedded chunk and
+    vectors.f32 the matching float32 rows; progress.json records how many
+    chunks (and bytes of each file) are durable. Writing a batch is O(batch).
+    """
+
+    def __init__(self, directory: str, fingerprint: dict):
+        self.directory = directory
+        self.chunks_path = os.path.join(directory, "chunks.jsonl")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.progress_path = os.path.join(directory, "progress.json")
+        self.fingerprint = fingerprint
+        self.chunks = 0
+        self.dim = None
+        progress = None
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path, 'r', encoding='utf-8') as f:
+                progress = json.load(f)
+        if progress is not None and progress.get("fingerprint") == fingerprint:
+            # Drop anything appended after the last durable progress record
+            for path, size in ((self.chunks_path, progress["chunks_bytes"]), (self.vectors_path, progress["vectors_bytes"])):
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+            self.chunks = progress["chunks"]
+            self.dim = progress["dim"]
+        else:
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+            os.makedirs(directory)
+            open(self.chunks_path, 'wb').close()
+            open(self.vectors_path, 'wb').close()
+
+    def append(self, docs: List[Document], vectors: List[List[float]]):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        self.dim = matrix.shape[1]
+        with open(self.chunks_path, 'ab') as f:
+            for doc in docs:
+                f.write((json.dumps({"text": doc.page_content, "metadata": doc.metadata}) + "\n").encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.vectors_path, 'ab') as f:
+            f.write(matrix.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.chunks += len(docs)
+        _write_json_atomic(self.progress_path, {
+            "fingerprint": self.fingerprint, "chunks": self.chunks, "dim": self.dim,
+            "chunks_bytes": os.path.getsize(self.chunks_path), "vectors_bytes": os.path.getsize(self.vectors_path),
+        })
+
+    def load(self):
+        texts, metadatas = [], []
+        with open(self.chunks_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                texts.append(record["text"])
+                metadatas.append(record["metadata"])
+        vectors = np.fromfile(self.vectors_path, dtype=np.float32)
+        vectors = vectors.reshape(-1, self.dim) if self.dim else vectors.reshape(0, 0)
+        return texts, vectors, metadatas
+
+
+def chunk_ids(texts: List[str]) -> List[str]:
+    # Docstore ids are content hashes, numbered so repeated chunks stay distinct
+    seen = {}
+    ids = []
+    for text in texts:
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        n = seen.get(digest, 0)
+        seen[digest] = n + 1
+        ids.append(f"{digest}-{n}")
+    return ids
+
+
+def build_index(source_path: str, index_dir: str, embeddings: Embeddings, batch_size: int = 64,
+                concurrency: int = 4, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> FAISS:
+    """Stream, embed and index source_path into index_dir, resuming an interrupted build.
+
+    Chunks are embedded in batches of batch_size with up to `concurrency` batches
+    in flight; every finished batch is checkpointed in <index_dir>.partial, so a
+    rerun after a failure skips the chunks already embedded. The final index is
+    written next to index_dir and swapped in atomically.
+    """
+    fingerprint = dict(_file_fingerprint(source_path), chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    checkpoint = _Checkpoint(index_dir + ".partial", fingerprint)
+    if checkpoint.chunks:
+        tracer.emit(logging.INFO, "index_build_resumed", index=index_dir, chunks=checkpoint.chunks)
+
+    chunks = itertools.islice(iter_chunks(source_path, chunk_size, chunk_overlap), checkpoint.chunks, None)
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        def drain_one():
+            # Batches are committed in submission order so the checkpoint stays a prefix
+            docs, future = in_flight.popleft()
+            checkpoint.append(docs, future.result())
+            tracer.emit(logging.INFO, "index_build_progress", index=index_dir, chunks=checkpoint.chunks)
+
+        for docs in _batched(chunks, batch_size):
+            in_flight.append((docs, pool.submit(embeddings.embed_documents, [d.page_content for d in docs])))
+            if len(in_flight) >= concurrency:
+                drain_one()
+        while in_flight:
+            drain_one()
+
+    texts, vectors, metadatas = checkpoint.load()
+    if not texts:
+        raise ValueError(f"No text to index in {source_path}")
+    vector_store = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas,
+                                         ids=chunk_ids(texts))
+    save_index(vector_store, index_dir)
+    shutil.rmtree(checkpoint.directory)
+    return vector_store
+
+
+def save_index(vector_store: FAISS, index_dir: str):
+    tmp_dir = index_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    vector_store.save_local(tmp_dir)
+    replace_dir(tmp_dir, index_dir)
+
+
+def update_index(source_path: str, index_dir: str, embeddings: Embeddings, batch_size: int = 64,
+                 concurrency: int = 4, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    """Bring index_dir in line with source_path, embedding only new or changed chunks.
+
+    The file is re-chunked and each chunk's content-hash id compared with the ids
+    already in the docstore: missing ids are embedded and added, ids no longer
+    produced are deleted, and kept chunks get their start_index refreshed. The
+    result is saved atomically. Returns the store and {"added", "removed", "kept"}.
+    """
+    if not os.path.exists(index_dir):
+        vector_store = build_index(source_path, index_dir, embeddings, batch_size, concurrency, chunk_size, chunk_overlap)
+        return vector_store, {"added": vector_store.index.ntotal, "removed": 0, "kept": 0}
+
+    vector_store = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+    docs = list(iter_chunks(source_path, chunk_size, chunk_overlap))
+    ids = chunk_ids([d.page_content for d in docs])
+    existing = set(vector_store.index_to_docstore_id.values())
+    wanted = set(ids)
+
+    removed = [i for i in existing if i not in wanted]
+    if removed:
+        vector_store.delete(removed)
+
+    new_docs = [(i, d) for i, d in zip(ids, docs) if i not in existing]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        batches = list(_batched(new_docs, batch_size))
+        futures = [pool.submit(embeddings.embed_documents, [d.page_content for _, d in batch]) for batch in batches]
+        for batch, future in zip(batches, futures):
+            vectors = future.result()
+            vector_store.add_embeddings([(d.page_content, v) for (_, d), v in zip(batch, vectors)],
+                                        metadatas=[d.metadata for _, d in batch], ids=[i for i, _ in batch])
+
+    # Unchanged chunks may have moved; keep their offsets current
+    stored = getattr(vector_store.docstore, '_dict', {})
+    for i, d in zip(ids, docs):
+        if i in existing and i in stored:
+            stored[i].metadata = d.metadata
+
+    save_index(vector_store, index_dir)
+    return vector_store, {"added": len(new_docs), "removed": len(removed), "kept": len(wanted & existing)}
+
+# --- Cached Embeddings ---
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that remembers vectors in memory and in SQLite across restarts.
+
+    Keys are sha256(model name, kind, text); queries and documents are cached apart
+    because providers such as Gemini embed them with different task types.
+    """
+
+    def __init__(self, underlying: Embeddings, path: Optional[str] = None, model_name: Optional[str] = None,
+                 max_memory_entries: int = 10000):
+        self.underlying = underlying
+        self.model_name = model_name or model_name_of(underlying)
+        self.memory = LRUCache(max_memory_entries)
+        self.store = SQLiteStore(path, "embeddings") if path else None
+        self.computed = 0
+
+    def _key(self, kind: str, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\x00{kind}\x00{text}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _pack(vector: List[float]) -> bytes:
+        return array('f', vector).tobytes()
+
+    @staticmethod
+    def _unpack(blob: bytes) -> List[float]:
+        vector = array('f')
+        vector.frombytes(blob)
+        return vector.tolist()
+
+    def _lookup(self, keys: List[str]) -> dict:
+        found = {}
+        missing = []
+        for key in keys:
+            vector = self.memory.get(key)
+            if vector is not None:
+                found[key] = vector
+            else:
+                missing.append(key)
+        if missing and self.store is not None:
+            for key, blob in self.store.get_many(set(missing)).items():
+                vector = self._unpack(blob)
+                self.memory.set(key, vector)
+                found[key] = vector
+        return found
+
+    def _remember(self, computed: dict):
+        for key, vector in computed.items():
+            self.memory.set(key, vector)
+        if self.store is not None:
+            self.store.set_many((key, self._pack(vector)) for key, vector in computed.items())
+        self.computed += len(computed)
+
+    def _misses(self, texts: List[str], keys: List[str], found: dict) -> dict:
+        # Unique uncached texts, in first-seen order, mapped by key
+        misses = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in misses:
+                misses[key] = text
+        return misses
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key("document", t) for t in texts]
+        found = self._lookup(keys)
+        misses = self._misses(texts, keys, found)
+        if misses:
+            vectors = self.underlying.embed_documents(list(misses.values()))
+            computed = dict(zip(misses.keys(), vectors))
+            self._remember(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key("query", text)
+        found = self._lookup([key])
+        if key not in found:
+            found[key] = self.underlying.embed_query(text)
+            self._remember({key: found[key]})
+        return found[key]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key("document", t) for t in texts]
+        found = self._lookup(keys)
+        misses = self._misses(texts, keys, found)
+        if misses:
+            vectors = await self.underlying.aembed_documents(list(misses.values()))
+            computed = dict(zip(misses.keys(), vectors))
+            self._remember(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key("query", text)
+        found = self._lookup([key])
+        if key not in found:
+            found[key] = await self.underlying.aembed_query(text)
+            self._remember({key: found[key]})
+        return found[key]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed many query strings with one provider request for all cache misses."""
+        keys = [self._key("query", t) for t in texts]
+        found = self._lookup(keys)
+        misses = self._misses(texts, keys, found)
+        if misses:
+            vectors = embed_queries(self.underlying, list(misses.values()))
+            computed = dict(zip(misses.keys(), vectors))
+            self._remember(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+
+def embed_queries(embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+    if hasattr(embeddings, 'embed_queries'):
+        return embeddings.embed_queries(texts)
+    # Providers such as Gemini batch documents and accept a query task type there
+    if 'task_type' in inspect.signature(embeddings.embed_documents).parameters:
+        return embeddings.embed_documents(texts, task_type="RETRIEVAL_QUERY")
+    return [embeddings.embed_query(t) for t in texts]
+
+# --- Batched Search ---
+def supports_vector_search(vector_store) -> bool:
+    # A LangChain FAISS store whose raw index can be searched with our own query vectors
+    return getattr(vector_store, 'index', None) is not None and hasattr(vector_store, 'index_to_docstore_id')
+
+
+def search_by_vectors(vector_store, vectors: List[List[float]], k: int = 4):
+    """One FAISS matrix search for already embedded queries; returns a list of documents per query."""
+    matrix = np.array(vectors, dtype=np.float32)
+    if getattr(vector_store, '_normalize_L2', False):
+        import faiss
+        faiss.normalize_L2(matrix)
+    _, indices = vector_store.index.search(matrix, k)
+    results = []
+    for row in indices:
+        docs = []
+        for i in row:
+            if i == -1:
+                continue
+            docs.append(vector_store.docstore.search(vector_store.index_to_docstore_id[i]))
+        results.append(docs)
+    return results
+
+
+def batch_similarity_search(vector_store, queries: List[str], k: int = 4):
+    """similarity_search for many queries: one embedding call and one FAISS matrix search."""
+    if not queries:
+        return []
+    if not supports_vector_search(vector_store):
+        return [vector_store.similarity_search(q, k=k) for q in queries]
+    return search_by_vectors(vector_store, embed_queries(vector_store.embeddings, queries), k)
+
+if __name__ == '__main__':
+    import argparse
+    import llmgraphbuilder
+
+    parser = argparse.ArgumentParser(description="Build or incrementally update the FAISS index for the documentation.")
+    parser.add_argument("command", choices=["build", "update"])
+    parser.add_argument("--source", default=llmgraphbuilder.file_path)
+    parser.add_argument("--index", default=llmgraphbuilder.index_dir)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_index(args.source, args.index, llmgraphbuilder.get_embeddings(),
+                    batch_size=args.batch_size, concurrency=args.concurrency)
+    else:
+        _, stats = update_index(args.source, args.index, llmgraphbuilder.get_embeddings(),
+                                batch_size=args.batch_size, concurrency=args.concurrency)
+        print(f"Index updated: {stats['added']} added, {stats['removed']} removed, {stats['kept']} unchanged")
+    llmgraphbuilder.retrieval_cache.invalidate()
@@ -0,0 +1,97 @@
+import re
+import time
+import asyncio
+import hashlib
+from typing import Any, Iterator, List, Optional
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# --- Offline Stand-ins ---
+# Deterministic replacements for the Gemini chat model and embeddings, so the
+# workflow engine can be run and measured without network access or API keys.
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers after `latency` seconds with `output_words` words derived from the prompt."""
+
+    latency: float = 0.0
+    output_words: int = 32
+    model: str = "fake-chat"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _reply(self, messages: List[BaseMessage]) -> str:
+        prompt = "".join(str(m.content) for m in messages)
+        seed = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        return " ".join(f"w{seed[i % 64]}{i}" for i in range(self.output_words))
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        words = self._reply(messages).split(" ")
+        for i, word in enumerate(words):
+            if self.latency:
+                time.sleep(self.latency / len(words))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+
+
+class HashingEmbeddings(Embeddings):
+    """Feature-hashing bag-of-words embeddings: local, deterministic and L2-normalized."""
+
+    def __init__(self, dim: int = 256, latency: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.model = f"hashing-{dim}"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in _WORD_RE.findall(text.lower()):
+            h = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[h % self.dim] += 1.0 if (h >> 63) == 0 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._embed(text)
+
+
+def local_vector_store(source_path: str, embeddings: Optional[Embeddings] = None, max_chunks: Optional[int] = None):
+    """In-memory FAISS index over source_path built with HashingEmbeddings (nothing is saved)."""
+    from langchain_community.vectorstores import FAISS
+    from docindex import iter_chunks
+
+    embeddings = embeddings or HashingEmbeddings()
+    docs = []
+    for doc in iter_chunks(source_path):
+        docs.append(doc)
+        if max_chunks is not None and len(docs) >= max_chunks:
+            break
+    return FAISS.from_documents(docs, embeddings)
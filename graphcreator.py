@@ -40,9 +40,10 @@ SCROLLBAR_HOVER = (150, 180, 210)  # Slightly darker for hover
 
 # Configuration field descriptions
 CONFIG_FIELDS = {
-    "retrieval": ["Manual Injection"],
-    "query": ["Behaviour"],
-    "condition": ["Trigger"]
+    "retrieval": ["Manual Injection", "Search Mode (vector, lexical, fused)", "Results"],
+    "query": ["Behaviour", "Token Budget", "Budget Priority (retrieval, memory, query)"],
+    "condition": ["Triggers (one per line)", "Match Options (any/all, ignorecase, word, regex)"],
+    "memory": ["Window Entries", "Window Words"]
     # Add more node types as needed
 }
 
@@ -407,19 +408,23 @@ class ConfigWindow:
                 try:
                     with open(file_path, 'r') as f:
                         file_content = f.read()
-                    # Store full content in node
+                    # The file extends the first field (behaviour, manual injection,
+                    # triggers): stored as a field of its own it would land in the
+                    # budget or option fields that follow
                     if not self.node.content:
                         self.node.content = []
-                    self.node.content.append(file_content)
+                    areas = [item[1] for item in self.inputs if item[0] == "input"]
+                    if areas:
+                        if self.node.content:
+                            self.node.content[0] = (self.node.content[0] or "") + file_content
+                        else:
+                            self.node.content.append(file_content)
+                        areas[0].text = '\n'.join(areas[0].lines) + file_content
+                        areas[0].lines = areas[0].text.split('\n')
+                    else:
+                        self.node.content.append(file_content)
                     self.drag_file_path = file_path
                     self.drag_error = None
-
-                    # Update the text area
-                    for item in self.inputs:
-                        if item[0] == "input" and not item[1].text.strip():
-                            item[1].text = file_content
-                            item[1].lines = file_content.split('\n')
-                            break
                 except Exception as e:
                     self.drag_error = f"Error: {str(e)}"
             else:
@@ -506,7 +511,7 @@ class Node:
             self.x + self.width - 25,
             self.y + 5,
             20, 20
-        ) if self.type not in ["input", "output", "memory"] else None  # Added memory to exclusion
+        ) if self.type not in ["input", "output"] else None
 
     def draw(self, surface, camera_offset_x, camera_offset_y):
         # Convert world coordinates to screen coordinates
@@ -0,0 +1,96 @@
+import re
+import math
+import heapq
+import threading
+import weakref
+from array import array
+from collections import Counter
+from operator import itemgetter
+from typing import Dict, List, Tuple
+
+# --- BM25 Inverted Index ---
+# Keyword search over the chunks of a loaded FAISS store, with no embedding
+# call. The index is built in memory from the store's docstore the first time
+# it is needed, so it always holds exactly the chunks of the vector index; a
+# reloaded or rebuilt store gets a new one.
+
+_TERM_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TERM_RE.findall(text.lower())
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of documents.
+
+    Every posting stores its document's precomputed term weight, so a search
+    only adds up the postings of the query terms.
+    """
+
+    def __init__(self, docs: list, k1: float = 1.5, b: float = 0.75):
+        self.docs = docs
+        counts = [Counter(tokenize(doc.page_content)) for doc in docs]
+        lengths = [sum(c.values()) for c in counts]
+        avg_length = (sum(lengths) / len(lengths) if lengths else 0) or 1
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for i, terms in enumerate(counts):
+            for term, tf in terms.items():
+                postings.setdefault(term, []).append((i, tf))
+        n = len(docs)
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        for term, entries in postings.items():
+            idf = math.log(1 + (n - len(entries) + 0.5) / (len(entries) + 0.5))
+            ids = array('I', (i for i, _ in entries))
+            weights = array('d', (idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[i] / avg_length))
+                                  for i, tf in entries))
+            self.postings[term] = (ids, weights)
+
+    @classmethod
+    def from_vector_store(cls, vector_store, **options) -> "BM25Index":
+        mapping = getattr(vector_store, 'index_to_docstore_id', None)
+        if mapping is None:
+            raise ValueError(f"Lexical search needs a FAISS store with a docstore, got {type(vector_store).__name__}")
+        docs = [vector_store.docstore.search(mapping[i]) for i in sorted(mapping)]
+        return cls(docs, **options)
+
+    def search(self, query: str, k: int = 4) -> list:
+        scores: Dict[int, float] = {}
+        for term, qtf in Counter(tokenize(query)).items():
+            entry = self.postings.get(term)
+            if entry is None:
+                continue
+            for i, weight in zip(*entry):
+                scores[i] = scores.get(i, 0.0) + qtf * weight
+        return [self.docs[i] for i, _ in heapq.nlargest(k, scores.items(), key=itemgetter(1))]
+
+
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+
+def index_for(vector_store) -> BM25Index:
+    index = _indexes.get(vector_store)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(vector_store)
+            if index is None:
+                index = _indexes[vector_store] = BM25Index.from_vector_store(vector_store)
+    return index
+
+# --- Rank Fusion ---
+def fusion_candidates(k: int) -> int:
+    # Results taken from each ranking before fusing down to k
+    return max(2 * k, 10)
+
+
+def fuse_rankings(rankings: List[list], k: int, constant: int = 60) -> list:
+    """Reciprocal rank fusion: each document scores sum(1 / (constant + rank)) over the rankings."""
+    scores: Dict[str, float] = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, 1):
+            key = doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (constant + rank)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in heapq.nlargest(k, scores, key=scores.get)]
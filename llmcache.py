@@ -0,0 +1,255 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+_MISSING = object()
+
+# --- In-Memory LRU Tier ---
+class LRUCache:
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = _MISSING
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+# --- Persistent SQLite Tier ---
+class SQLiteStore:
+    def __init__(self, path: str, table: str = "cache", max_entries: Optional[int] = None,
+                 ttl: Optional[float] = None, prune_every: int = 100):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use so constructing a store does no disk work, and
+        # reopened in a forked worker instead of sharing the parent's handle
+        if self._conn is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                               "(key TEXT PRIMARY KEY, value BLOB, created REAL)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._connect().execute(
+                f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and time.time() - row[1] > self.ttl:
+            return None
+        return row[0]
+
+    def get_many(self, keys) -> Dict[str, Any]:
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(f"SELECT key, value, created FROM {self.table} WHERE key IN ({placeholders})",
+                                    batch).fetchall()
+                for key, value, created in rows:
+                    if self.ttl is None or now - created <= self.ttl:
+                        found[key] = value
+        return found
+
+    def set(self, key: str, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        items = list(items)
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(f"INSERT OR REPLACE INTO {self.table} (key, value, created) VALUES (?, ?, ?)",
+                             [(key, value, now) for key, value in items])
+            conn.commit()
+            before = self._writes
+            self._writes += len(items)
+            if self._writes // self.prune_every != before // self.prune_every:
+                self._prune(conn)
+
+    def _prune(self, conn: sqlite3.Connection):
+        if self.ttl is not None:
+            conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            conn.execute(f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+                         "ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        conn.commit()
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(f"DELETE FROM {self.table}")
+            conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+# --- LLM Response Cache ---
+class ResponseCache:
+    """Two-tier (memory LRU, then SQLite) cache of LLM replies keyed by model + prompt."""
+
+    def __init__(self, path: Optional[str] = None, max_memory_entries: int = 1024,
+                 max_disk_entries: Optional[int] = 100000, ttl: Optional[float] = None):
+        self.memory = LRUCache(max_memory_entries, ttl)
+        self.disk = SQLiteStore(path, "responses", max_disk_entries, ttl) if path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\x00{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        key = self.make_key(model, prompt)
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, model: str, prompt: str, response: str):
+        key = self.make_key(model, prompt)
+        self.memory.set(key, response)
+        if self.disk is not None:
+            self.disk.set(key, response)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"memory_entries": len(self.memory), "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits, "misses": self.misses}
+
+
+def model_name_of(llm) -> str:
+    return str(getattr(llm, 'model', None) or getattr(llm, 'model_name', None) or type(llm).__name__)
+
+# --- Retrieval Result Cache ---
+INDEX_FILES = ("index.faiss", "index.pkl")
+
+
+def index_stamp(index_dir: Optional[str]):
+    """(mtime, size) of the FAISS index files; changes whenever save_local rewrites them."""
+    if index_dir is None:
+        return None
+    stamp = []
+    for name in INDEX_FILES:
+        try:
+            st = os.stat(os.path.join(index_dir, name))
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class RetrievalCache:
+    """LRU of similarity_search results keyed by normalized query text and search parameters.
+
+    Entries are dropped whenever the on-disk FAISS index changes (files in index_dir
+    are re-stamped on save_local) or invalidate() is called after an in-process rebuild.
+    """
+
+    INDEX_FILES = INDEX_FILES
+
+    def __init__(self, index_dir: Optional[str] = None, max_entries: int = 512, ttl: Optional[float] = 600):
+        self.index_dir = index_dir
+        self.lru = LRUCache(max_entries, ttl)
+        self._index_stamp = _MISSING
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def _current_index_stamp(self):
+        return index_stamp(self.index_dir)
+
+    def _check_index(self):
+        stamp = self._current_index_stamp()
+        with self._lock:
+            if stamp != self._index_stamp:
+                self.lru.clear()
+                self._index_stamp = stamp
+
+    def make_key(self, text: str, k: int, **params):
+        return (self.normalize(text), k, tuple(sorted(params.items())))
+
+    def get(self, text: str, k: int, **params):
+        self._check_index()
+        docs = self.lru.get(self.make_key(text, k, **params))
+        return list(docs) if docs is not None else None
+
+    def set(self, text: str, k: int, docs, **params):
+        self.lru.set(self.make_key(text, k, **params), tuple(docs))
+
+    def invalidate(self):
+        with self._lock:
+            self.lru.clear()
+            self._index_stamp = _MISSING
+
+    def stats(self) -> Dict[str, int]:
+        return self.lru.stats()
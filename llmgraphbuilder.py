@@ -1,43 +1,153 @@
-import sys
 import os
 import json
+import hashlib
+import asyncio
+import threading
+import queue
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Dict, Any, List
-from langchain.chat_models import init_chat_model
-from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_core.documents import Document
-from langchain_core.messages import HumanMessage
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from llmcache import ResponseCache, RetrievalCache, index_stamp, model_name_of
+from memorystore import MemoryStore
+from conditionmatch import ConditionMatcher, match_options
+from promptbudget import PromptPacker, Segments, budget_fields, input_kind, query_prefix
+import metrics
+from tracing import tracer
 
 # --- Environment Configuration ---
-os.environ["LANGSMITH_TRACING"] = "true"
-os.environ["LANGSMITH_API_KEY"] = "key"
+# LangSmith tracing of LLM calls is opt-in: set LANGSMITH_TRACING=true to enable
+# it, and LANGSMITH_TRACING_SAMPLING_RATE (0-1, read by the LangSmith client) to
+# send only that share of runs. Local tracing is configured in tracing.py.
+os.environ.setdefault("LANGSMITH_TRACING", "false")
+os.environ.setdefault("LANGSMITH_API_KEY", "key")
 os.environ["GOOGLE_API_KEY"] = "key"
 
-# --- LLM and Embeddings Initialization ---
-llm = init_chat_model("gemini-2.0-flash-lite", model_provider="google_genai")
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-
 # --- File and Index Paths ---
 script_dir = os.path.dirname(os.path.abspath(__file__))
 file_path = os.path.join(script_dir, "Documentation.txt")
 index_dir = os.path.join(script_dir, "faiss_Documentation")
+response_cache_path = os.path.join(script_dir, "llm_cache.sqlite")
+embedding_cache_path = os.path.join(script_dir, "embedding_cache.sqlite")
+
+# --- LLM Response Cache ---
+# Replies to identical prompts are served from memory, then from SQLite on disk.
+# Set RESPONSE_CACHE_TTL (seconds) to expire entries; 0 disables the cache.
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+response_cache = ResponseCache(response_cache_path, max_memory_entries=1024, max_disk_entries=100000,
+                               ttl=RESPONSE_CACHE_TTL) if RESPONSE_CACHE_TTL > 0 else None
+
+# --- Memory Store ---
+# Shared by every compiled workflow so rebuilding a graph keeps the loaded history.
+shared_memory_store = MemoryStore(script_dir)
+
+# --- Retrieval Result Cache ---
+# Repeated retrieval inputs skip the query embedding and FAISS search; entries
+# are invalidated whenever the index in faiss_Documentation is rebuilt.
+retrieval_cache = RetrievalCache(index_dir, max_entries=512, ttl=600)
+
+# --- LLM, Embeddings and FAISS Index (lazy) ---
+# Importing this module does no network or disk work: the chat model, the
+# embeddings client and the vector store are created on first use, or injected
+# up front with configure(). `llmgraphbuilder.llm` etc. still resolve lazily.
+LLM_MODEL = "gemini-2.0-flash-lite"
+LLM_PROVIDER = "google_genai"
+EMBEDDING_MODEL = "models/embedding-001"
+# LLM calls a query node has in flight for a batch (ask_questions, /run_batch)
+LLM_BATCH_CONCURRENCY = int(os.environ.get("LLM_BATCH_CONCURRENCY", "32"))
+
+_resources: Dict[str, Any] = {'llm': None, 'embeddings': None, 'vector_store': None}
+_injected = set()
+_resources_lock = threading.RLock()
+_vector_store_stamp = None
+
+def get_llm():
+    llm = _resources['llm']
+    if llm is None:
+        with _resources_lock:
+            if _resources['llm'] is None:
+                from langchain.chat_models import init_chat_model
+                _resources['llm'] = init_chat_model(LLM_MODEL, model_provider=LLM_PROVIDER)
+            llm = _resources['llm']
+    return llm
+
+def get_embeddings():
+    # Embeddings go through a persistent cache shared by index builds and queries.
+    embeddings = _resources['embeddings']
+    if embeddings is None:
+        with _resources_lock:
+            if _resources['embeddings'] is None:
+                from langchain_google_genai import GoogleGenerativeAIEmbeddings
+                from docindex import CachedEmbeddings
+                _resources['embeddings'] = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL),
+                                                            embedding_cache_path)
+            embeddings = _resources['embeddings']
+    return embeddings
+
+def get_vector_store():
+    # Built (if missing) on first use. After that, the index is reloaded as soon
+    # as its files change on disk (e.g. `python docindex.py update` while the
+    # server runs), and the lexical index and retrieval cache follow the new store.
+    global _vector_store_stamp
+    vector_store = _resources['vector_store']
+    if 'vector_store' in _injected:
+        return vector_store
+    stamp = index_stamp(index_dir)
+    if vector_store is None or stamp != _vector_store_stamp:
+        with _resources_lock:
+            if _resources['vector_store'] is None:
+                from docindex import load_or_build_index
+                _resources['vector_store'] = load_or_build_index(index_dir, file_path, get_embeddings(),
+                                                                 on_rebuild=retrieval_cache.invalidate)
+                _vector_store_stamp = index_stamp(index_dir)
+            elif stamp != _vector_store_stamp:
+                _reload_vector_store(stamp)
+            vector_store = _resources['vector_store']
+    return vector_store
 
-# --- Load or Build FAISS Index ---
-if os.path.exists(index_dir):
-    vector_store = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
-else:
+def _reload_vector_store(stamp):
+    # Only ever loads: a request must not start an index build. While the index
+    # is being swapped (files missing, or replaced during the load) the current
+    # store stays in use and the load is retried once the files change again.
+    global _vector_store_stamp
+    from docindex import load_index
+    _vector_store_stamp = stamp
+    if stamp is None or None in stamp:
+        return
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-    except FileNotFoundError:
-        sys.exit(1)
+        vector_store = load_index(index_dir, get_embeddings())
+    except Exception as e:
+        tracer.emit(logging.WARNING, "index_reload_failed", index=index_dir, error=repr(e))
+        return
+    if index_stamp(index_dir) != stamp:
+        return
+    _resources['vector_store'] = vector_store
+    retrieval_cache.invalidate()
+    tracer.emit(logging.INFO, "index_reloaded", index=index_dir)
+
+def reload_vector_store():
+    # Force a reload from index_dir on the next retrieval, whatever its stamp
+    global _vector_store_stamp
+    with _resources_lock:
+        _vector_store_stamp = None
+    retrieval_cache.invalidate()
+
+def configure(llm=None, embeddings=None, vector_store=None):
+    with _resources_lock:
+        for name, value in (('llm', llm), ('embeddings', embeddings), ('vector_store', vector_store)):
+            if value is not None:
+                _resources[name] = value
+                _injected.add(name)
 
-    docs = [Document(page_content=text)]
-    splitter = RecursiveCharacterTextSplitter(chunk_size=400, chunk_overlap=100, add_start_index=True)
-    chunks = splitter.split_documents(docs)
-    vector_store = FAISS.from_documents(chunks, embeddings)
-    vector_store.save_local(index_dir)
+def __getattr__(name):
+    if name == 'llm':
+        return get_llm()
+    if name == 'embeddings':
+        return get_embeddings()
+    if name == 'vector_store':
+        return get_vector_store()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # --- Graph Data Structures ---
 class Node:
@@ -57,9 +167,14 @@ class Graph:
         self.nodes = []
         self.connections = []
         self.next_node_id = 1
+        # Indexes kept in sync by add_node/add_connection/remove_nodes/from_dict
+        self._nodes_by_id: Dict[int, Node] = {}
+        self._incoming: Dict[int, List[Connection]] = {}
+        self._outgoing: Dict[int, List[Connection]] = {}
+        self._edge_keys = set()
 
     def get_node_by_id(self, node_id: int) -> Node:
-        return next((n for n in self.nodes if n.id == node_id), None)
+        return self._nodes_by_id.get(node_id)
 
     def get_inp_node(self):
         for n in self.nodes:
@@ -67,30 +182,72 @@ class Graph:
                 return n
         return None
 
+    def get_incoming_connections(self, node: Node) -> List[Connection]:
+        return self._incoming.get(node.id, []) if node is not None else []
+
+    def get_outgoing_connections(self, node: Node) -> List[Connection]:
+        return self._outgoing.get(node.id, []) if node is not None else []
+
     def get_incoming_edge_nodes(self, node: Node):
-        return [c.from_node for c in self.connections if c.to_node == node]
+        return [c.from_node for c in self.get_incoming_connections(node)]
 
     def get_outgoing_edge_nodes(self, node: Node):
-        return [c.to_node for c in self.connections if c.from_node == node]
+        return [c.to_node for c in self.get_outgoing_connections(node)]
+
+    def _index_node(self, node: Node):
+        self.nodes.append(node)
+        self._nodes_by_id[node.id] = node
+        self._incoming[node.id] = []
+        self._outgoing[node.id] = []
 
     def add_node(self, node_type: str, content=None) -> Node:
         node = Node(self.next_node_id, node_type, content)
-        self.nodes.append(node)
+        self._index_node(node)
         self.next_node_id += 1
         return node
 
     def add_connection(self, from_node: Node, to_node: Node, output_type="output"):
-        for connection in self.connections:
-            if (connection.from_node == from_node and
-                    connection.to_node == to_node and
-                    connection.output_type == output_type):
-                return
+        key = (from_node.id, to_node.id, output_type)
+        if key in self._edge_keys:
+            return
+        self._edge_keys.add(key)
         new_connection = Connection(from_node, to_node, output_type)
         self.connections.append(new_connection)
+        self._outgoing[from_node.id].append(new_connection)
+        self._incoming[to_node.id].append(new_connection)
 
     def remove_node(self, node: Node):
-        self.connections = [c for c in self.connections if c.from_node != node and c.to_node != node]
-        self.nodes.remove(node)
+        self.remove_nodes([node])
+
+    def remove_nodes(self, nodes: List[Node]):
+        removed = {n.id for n in nodes}
+        if not removed:
+            return
+        for nid in removed:
+            for c in self._outgoing.pop(nid, []):
+                if c.to_node.id not in removed:
+                    self._incoming[c.to_node.id].remove(c)
+                self._edge_keys.discard((c.from_node.id, c.to_node.id, c.output_type))
+            for c in self._incoming.pop(nid, []):
+                if c.from_node.id not in removed:
+                    self._outgoing[c.from_node.id].remove(c)
+                self._edge_keys.discard((c.from_node.id, c.to_node.id, c.output_type))
+            self._nodes_by_id.pop(nid, None)
+        self.connections = [c for c in self.connections if c.from_node.id not in removed and c.to_node.id not in removed]
+        self.nodes = [n for n in self.nodes if n.id not in removed]
+
+    def reachable_from(self, start_node: Node) -> set:
+        if start_node is None:
+            return set()
+        seen = {start_node.id}
+        stack = [start_node]
+        while stack:
+            node = stack.pop()
+            for c in self._outgoing[node.id]:
+                if c.to_node.id not in seen:
+                    seen.add(c.to_node.id)
+                    stack.append(c.to_node)
+        return seen
 
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -101,264 +258,1101 @@ class Graph:
     def from_dict(self, graph_dict):
         self.nodes = []
         self.connections = []
-        node_id_map = {}
+        self._nodes_by_id = {}
+        self._incoming = {}
+        self._outgoing = {}
+        self._edge_keys = set()
         for node_data in graph_dict["nodes"]:
             node = Node(node_data["id"], node_data["type"])
             node.content = node_data.get("content", [])
-            self.nodes.append(node)
-            node_id_map[node_data["id"]] = node
+            self._index_node(node)
             if node.id >= self.next_node_id:
                 self.next_node_id = node.id + 1
         for conn_data in graph_dict["connections"]:
-            from_node = node_id_map[conn_data["from"]]
-            to_node = node_id_map[conn_data["to"]]
+            from_node = self._nodes_by_id[conn_data["from"]]
+            to_node = self._nodes_by_id[conn_data["to"]]
             output_type = conn_data.get("output_type", "output")
             self.add_connection(from_node, to_node, output_type)
 
     def topological_sort(self) -> List[int]:
-        indegree = {n.id: 0 for n in self.nodes}
-        for c in self.connections:
-            indegree[c.to_node.id] += 1
-        queue = [n.id for n in self.nodes if indegree[n.id] == 0]
+        indegree = {n.id: len(self._incoming[n.id]) for n in self.nodes}
+        queue = deque(n.id for n in self.nodes if indegree[n.id] == 0)
         order = []
         while queue:
-            nid = queue.pop(0)
+            nid = queue.popleft()
             order.append(nid)
-            for c in self.connections:
-                if c.from_node.id == nid:
-                    indegree[c.to_node.id] -= 1
-                    if indegree[c.to_node.id] == 0:
-                        queue.append(c.to_node.id)
+            for c in self._outgoing[nid]:
+                indegree[c.to_node.id] -= 1
+                if indegree[c.to_node.id] == 0:
+                    queue.append(c.to_node.id)
         if len(order) != len(self.nodes):
             raise ValueError("Cycle detected in the graph; cannot proceed.")
         return order
 
 # --- DAG-Based RAG Workflow ---
+# Node types that block on the network and are worth handing to the thread pool;
+# everything else is cheap and runs inline on the scheduling thread.
+PARALLEL_NODE_TYPES = ('query', 'retrieval')
+# Node types that are skipped unless every input ran; the others always run.
+GATED_NODE_TYPES = ('query', 'retrieval')
+# Retrieval node search modes: FAISS similarity, BM25 keywords (no embedding
+# call), or both merged by reciprocal rank fusion (see lexicalindex.py)
+RETRIEVAL_MODES = ('vector', 'lexical', 'fused')
+
 class LLMWorkflow:
-    def __init__(self, graph: Graph, vector_store: FAISS, llm):
+    def __init__(self, graph: Graph, vector_store=None, llm=None, max_workers: int = 4,
+                 response_cache: ResponseCache = None, retrieval_cache: RetrievalCache = None,
+                 memory_store: MemoryStore = None, name: str = "graph", optimize: bool = True,
+                 tokenizer=None, pool_size: int = 64, batch_concurrency: int = None):
+        # vector_store / llm left as None resolve to the module's lazily created ones
+        # max_workers bounds the chains one request runs at once; pool_size the
+        # threads shared by all concurrent requests of this workflow;
+        # batch_concurrency the LLM calls of one query node in a batch
+        # (default LLM_BATCH_CONCURRENCY)
+        # name labels this workflow's series on the /metrics endpoint
+        # optimize enables the build-time optimizer (see the Optimizer section)
+        # tokenizer counts tokens for query node budgets (see promptbudget.py);
+        # None loads PROMPT_TOKENIZER the first time a budgeted prompt is packed
         self.graph = graph
-        self.vector_store = vector_store
-        self.llm = llm
+        self.name = name
+        self.optimize = optimize
+        self.tokenizer = tokenizer
+        self.memory_store = memory_store if memory_store is not None else shared_memory_store
+        self._vector_store = vector_store
+        self._llm = llm
+        self.response_cache = response_cache
+        self.retrieval_cache = retrieval_cache
+        self.max_workers = max_workers
+        self.pool_size = pool_size
+        self.batch_concurrency = batch_concurrency or LLM_BATCH_CONCURRENCY
         self.node_funcs: Dict[int, Any] = {}
+        self.async_node_funcs: Dict[int, Any] = {}
+        self.batch_node_funcs: Dict[int, Any] = {}
+        self.stream_nodes = set()
         self.exec_order: List[int] = []
+        self.successors: Dict[int, List[int]] = {}
+        self.indegree: Dict[int, int] = {}
+        self.slot_of: Dict[int, int] = {}
+        self.read_slots: Dict[int, List[int]] = {}
+        self.reader_counts: List[int] = []
+        self.node_bits: Dict[int, int] = {}
+        self.branch_skips: Dict[int, Dict[str, int]] = {}
+        self.aliases: Dict[int, int] = {}
+        self.chains: Dict[int, List[int]] = {}
+        self.parallel_nodes = set()
+        self.optimization_report: Dict[str, Any] = {}
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def llm(self):
+        return self._llm if self._llm is not None else get_llm()
+
+    @llm.setter
+    def llm(self, value):
+        self._llm = value
+
+    @property
+    def vector_store(self):
+        return self._vector_store if self._vector_store is not None else get_vector_store()
+
+    @vector_store.setter
+    def vector_store(self, value):
+        self._vector_store = value
+
+    @property
+    def model_name(self) -> str:
+        return model_name_of(self.llm)
 
     def get_graph(self, path: str):
         try:
             with open(path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
             self.graph.from_dict(data)
-            print("Graph loaded:")
-            print(json.dumps(self.graph.to_dict(), indent=2))
+            tracer.emit(logging.INFO, "graph_loaded", path=path, nodes=len(self.graph.nodes),
+                        connections=len(self.graph.connections))
+            if tracer.full:
+                tracer.emit(logging.DEBUG, "graph", path=path, graph=json.dumps(self.graph.to_dict(), indent=2))
         except FileNotFoundError:
-            print(f"No saved graph at {path}")
+            tracer.emit(logging.WARNING, "graph_missing", path=path)
 
-    def clear_memory(self):
+    def clear_memory(self, session_id: str = None):
         memory_nodes = [node for node in self.graph.nodes if node.type == 'memory']
         for memory_node in memory_nodes:
-            file_path = os.path.join(script_dir, f"memory_{memory_node.id}.txt")
-            with open(file_path, 'w', encoding='utf-8') as f:
-                pass  # Clear the file
+            self.memory_store.clear(memory_node.id, session_id)
+
+    def _legacy_content(self, node: Node):
+        # Content that does not fit the node's configuration fields is read the
+        # way graphs from before those fields were, not rejected
+        tracer.emit(logging.WARNING, "legacy_node_content", graph=self.name, node_id=node.id,
+                    node_type=node.type, fields=len(node.content))
+
+    @staticmethod
+    def memory_window(node: Node):
+        # Memory node content: [max entries, max words]; blank fields mean
+        # unbounded. Words are the memory store's token_counter (whitespace
+        # words), not the prompt budget's tokenizer. Returns None for content
+        # that is not that layout.
+        if len(node.content) > 2:
+            return None
+        window = []
+        for i in range(2):
+            value = node.content[i].strip() if i < len(node.content) and node.content[i] else ""
+            if not value:
+                window.append(None)
+            elif value.isdigit():
+                window.append(int(value))
+            else:
+                return None
+        return tuple(window)
+
+    @staticmethod
+    def retrieval_options(node: Node):
+        # Retrieval node content: [manual injection, search mode, results]; blank
+        # fields mean vector search and 4 results. Returns None for content that
+        # is not that layout (older nodes could hold a dropped file there).
+        if len(node.content) > 3:
+            return None
+        mode = node.content[1].strip().lower() if len(node.content) > 1 and node.content[1] else ""
+        mode = mode or 'vector'
+        k = node.content[2].strip() if len(node.content) > 2 and node.content[2] else "4"
+        if mode not in RETRIEVAL_MODES or not k.isdigit() or int(k) == 0:
+            return None
+        return mode, int(k)
 
     def build(self):
+        from langchain_core.messages import HumanMessage
+
         start_node = self.graph.get_inp_node()
-        reachable = [start_node]
+        reachable = self.graph.reachable_from(start_node)
+        self.graph.remove_nodes([n for n in self.graph.nodes if n.id not in reachable])
+
+        def phase(node: Node, name: str):
+            return metrics.phase_seconds.time(graph=self.name, node_id=node.id, phase=name)
 
-        def reachable_nodes(node: Node):
-            if node not in reachable:
-                reachable.append(node)
-            out = self.graph.get_outgoing_edge_nodes(node)
-            for n in out:
-                reachable_nodes(n)
+        def detail(state: Dict[str, Any]):
+            # The request's trace when node-level events are being logged, else None
+            trace = state['trace']
+            return trace if trace is not None and trace.detail else None
 
-        reachable_nodes(start_node)
-        for n in self.graph.nodes[:]:
-            if n not in reachable:
-                self.graph.remove_node(n)
+        def input_slots(node: Node) -> List[int]:
+            # Slots of the values node reads, in connection order
+            return [self.slot_of[i.id] for i in self.graph.get_incoming_edge_nodes(node) if self.reads_input(node, i)]
+
+        memory_targets = {n.id: [c.to_node.id for c in self.graph.get_outgoing_connections(n) if c.to_node.type == 'memory']
+                          for n in self.graph.nodes}
+
+        def write_memory_targets(node: Node, state: Dict[str, Any]):
+            # Buffered per request and appended in topological order of the writers
+            # (see _apply_memory_writes), so nodes finishing concurrently cannot
+            # reorder a memory node's entries
+            targets = memory_targets[node.id]
+            if targets:
+                text = str(state['slots'][self.slot_of[node.id]])
+                writes = state['memory_writes']
+                for memory_node_id in targets:
+                    writes.setdefault(memory_node_id, []).append((self.slot_of[node.id], text))
+
+        self.exec_order = self.graph.topological_sort()
+        self.aliases = self._find_common_nodes() if self.optimize else {}
+        self._plan_slots()
+        self._plan_activation()
 
-        # Factories for each node type
+        # Factories for each node type. Retrieval and query nodes also return an
+        # async variant that awaits the vector store / LLM instead of blocking, and
+        # a batch variant that serves a whole list of states with one call.
         def input_factory(node: Node):
+            slot = self.slot_of[node.id]
+
             def fn(state: Dict[str, Any]) -> Dict[str, Any]:
-                print(f"[Node {node.id} - INPUT] question='{state['question']}'")
-                state["activation"][str(node.id)] = True
-                state['data'][str(node.id)] = state['question']
-                memory_targets = [c.to_node.id for c in self.graph.connections if c.from_node == node and c.to_node.type == 'memory']
-                for memory_node_id in memory_targets:
-                    file_path = os.path.join(script_dir, f"memory_{memory_node_id}.txt")
-                    try:
-                        with open(file_path, 'a', encoding='utf-8') as f:
-                            f.write(str(state['data'][str(node.id)]) + "\n\n")
-                    except (PermissionError, OSError) as e:
-                        print(f"Error writing to {file_path}: {e}")
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "input", question=state['question'])
+                state['slots'][slot] = state['question']
+                write_memory_targets(node, state)
                 return state
             return fn
 
         def retrieval_factory(node: Node):
+            from docindex import embed_queries, search_by_vectors, supports_vector_search
+            from lexicalindex import index_for, fusion_candidates, fuse_rankings
+            slot = self.slot_of[node.id]
+            inputs = input_slots(node)
+            options = self.retrieval_options(node)
+            if options is None:
+                # Old retrieval nodes ignored their content
+                self._legacy_content(node)
+                options = ('vector', 4)
+            mode, k = options
+            n = fusion_candidates(k) if mode == 'fused' else k
+
+            def prepare(state: Dict[str, Any]):
+                # Only called for active states, so every non-condition input has run
+                slots = state['slots']
+                inp = "".join(slots[p] for p in inputs)
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "retrieval_input", text=inp)
+                return inp
+
+            def finish(state: Dict[str, Any], docs):
+                # Chunks stay separable, in rank order, for budgeted prompts
+                text = Segments([doc.page_content for doc in docs])
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "retrieved", docs=len(docs), text=text)
+                state['slots'][slot] = text
+                write_memory_targets(node, state)
+
+            def cached(state: Dict[str, Any], inp: str):
+                if self.retrieval_cache is None:
+                    return None
+                docs = self.retrieval_cache.get(inp, k=k, mode=mode)
+                metrics.cache_requests.inc(graph=self.name, cache="retrieval", result="miss" if docs is None else "hit")
+                trace = detail(state)
+                if docs is not None and trace:
+                    trace.node(node, "retrieval_cache_hit")
+                return docs
+
+            def store(inp: str, docs):
+                if self.retrieval_cache is not None:
+                    self.retrieval_cache.set(inp, k, docs, mode=mode)
+
+            def lexical_search(inp: str):
+                with phase(node, 'lexical_search'):
+                    return index_for(self.vector_store).search(inp, n)
+
+            # Embedding and FAISS search are run (and timed) separately when the
+            # store exposes its index; other vector stores are timed as one search.
+            def vector_search(inp: str):
+                vector_store = self.vector_store
+                if not supports_vector_search(vector_store):
+                    with phase(node, 'faiss_search'):
+                        return vector_store.similarity_search(inp, k=n)
+                with phase(node, 'embedding'):
+                    vector = vector_store.embeddings.embed_query(inp)
+                with phase(node, 'faiss_search'):
+                    return search_by_vectors(vector_store, [vector], k=n)[0]
+
+            async def avector_search(inp: str):
+                vector_store = self.vector_store
+                if not supports_vector_search(vector_store):
+                    with phase(node, 'faiss_search'):
+                        return await vector_store.asimilarity_search(inp, k=n)
+                with phase(node, 'embedding'):
+                    vector = await vector_store.embeddings.aembed_query(inp)
+                with phase(node, 'faiss_search'):
+                    results = await asyncio.get_running_loop().run_in_executor(
+                        None, search_by_vectors, vector_store, [vector], n)
+                return results[0]
+
+            def search(inp: str):
+                if mode == 'lexical':
+                    return lexical_search(inp)
+                if mode == 'vector':
+                    return vector_search(inp)
+                return fuse_rankings([vector_search(inp), lexical_search(inp)], k)
+
+            async def asearch(inp: str):
+                if mode == 'vector':
+                    return await avector_search(inp)
+                lexical = asyncio.get_running_loop().run_in_executor(None, lexical_search, inp)
+                if mode == 'lexical':
+                    return await lexical
+                vector, lexical = await asyncio.gather(avector_search(inp), lexical)
+                return fuse_rankings([vector, lexical], k)
+
             def fn(state: Dict[str, Any]) -> Dict[str, Any]:
-                incoming = self.graph.get_incoming_edge_nodes(node)
-                flag = True
-                for i in incoming:
-                    if i.type != "condition":
-                        if str(i.id) in state['activation'].keys() and not state['activation'][str(i.id)]:
-                            flag = False
-                        elif str(i.id) not in state['activation'].keys():
-                            flag = False
-                if flag:
-                    texts = [state['data'][str(i.id)] for i in incoming if i.type != "condition"]
-                    print(f"[Node {node.id} - RETRIEVAL] inputs={texts}")
-                    inp = "".join(texts)
-                    docs = self.vector_store.similarity_search(inp, k=4)
-                    print(f"[Node {node.id}] retrieved: " + "\n\n".join(doc.page_content for doc in docs))
-                    state["data"][str(node.id)] = "\n\n".join(doc.page_content for doc in docs)
-                    state["activation"][str(node.id)] = True
-                    memory_targets = [c.to_node.id for c in self.graph.connections if c.from_node == node and c.to_node.type == 'memory']
-                    for memory_node_id in memory_targets:
-                        file_path = os.path.join(script_dir, f"memory_{memory_node_id}.txt")
-                        try:
-                            with open(file_path, 'a', encoding='utf-8') as f:
-                                f.write(str(state['data'][str(node.id)]) + "\n\n")
-                        except (PermissionError, OSError) as e:
-                            print(f"Error writing to {file_path}: {e}")
+                inp = prepare(state)
+                docs = cached(state, inp)
+                if docs is None:
+                    docs = search(inp)
+                    store(inp, docs)
+                finish(state, docs)
+                return state
+
+            async def afn(state: Dict[str, Any]) -> Dict[str, Any]:
+                inp = prepare(state)
+                docs = cached(state, inp)
+                if docs is None:
+                    docs = await asearch(inp)
+                    store(inp, docs)
+                finish(state, docs)
                 return state
-            return fn
+
+            def bfn(states: List[Dict[str, Any]]):
+                # Identical inputs across the batch share one search
+                waiting: Dict[str, List[Dict[str, Any]]] = {}
+                for state in states:
+                    inp = prepare(state)
+                    docs = cached(state, inp)
+                    if docs is not None:
+                        finish(state, docs)
+                    else:
+                        waiting.setdefault(inp, []).append(state)
+                if waiting:
+                    inputs = list(waiting)
+                    vector_store = self.vector_store
+                    if mode == 'lexical':
+                        results = [lexical_search(inp) for inp in inputs]
+                    elif supports_vector_search(vector_store):
+                        with phase(node, 'embedding'):
+                            vectors = embed_queries(vector_store.embeddings, inputs)
+                        with phase(node, 'faiss_search'):
+                            results = search_by_vectors(vector_store, vectors, k=n)
+                    else:
+                        with phase(node, 'faiss_search'):
+                            results = [vector_store.similarity_search(inp, k=n) for inp in inputs]
+                    if mode == 'fused':
+                        results = [fuse_rankings([docs, lexical_search(inp)], k) for inp, docs in zip(inputs, results)]
+                    for inp, docs in zip(inputs, results):
+                        store(inp, docs)
+                        for state in waiting[inp]:
+                            finish(state, docs)
+            return fn, afn, bfn
 
         def condition_factory(node: Node):
+            slot = self.slot_of[node.id]
+            inputs = input_slots(node)
+            targets = {branch: [str(c.to_node.id) for c in self.graph.get_outgoing_connections(node) if c.output_type == branch]
+                       for branch in ("true", "false")}
+            if match_options(node.content) is None:
+                self._legacy_content(node)
+            try:
+                matcher = ConditionMatcher.from_content(node.content)
+            except ValueError as e:
+                raise ValueError(f"Invalid condition on node {node.id}: {e}") from e
+
             def fn(state: Dict[str, Any]) -> Dict[str, Any]:
-                incoming = self.graph.get_incoming_edge_nodes(node)
-                texts = [state['data'][str(i.id)] for i in incoming if str(i.id) in state['data']]
-                if len(node.content) == 0:
-                    raise ValueError(f"Condition node empty")
-                if node.content[0] in ''.join(texts):
-                    state['data'][str(node.id)] = [str(c.to_node.id) for c in self.graph.connections if c.from_node == node and c.output_type == "true"]
-                    print("True")
-                else:
-                    state['data'][str(node.id)] = [str(c.to_node.id) for c in self.graph.connections if c.from_node == node and c.output_type == "false"]
-                    print("False")
-                state["activation"][str(node.id)] = True
-                memory_targets = [c.to_node.id for c in self.graph.connections if c.from_node == node and c.to_node.type == 'memory']
-                for memory_node_id in memory_targets:
-                    file_path = os.path.join(script_dir, f"memory_{memory_node_id}.txt")
-                    try:
-                        with open(file_path, 'a', encoding='utf-8') as f:
-                            f.write(str(state['data'][str(node.id)]) + "\n\n")
-                    except (PermissionError, OSError) as e:
-                        print(f"Error writing to {file_path}: {e}")
+                slots = state['slots']
+                texts = [slots[p] for p in inputs if slots[p] is not None]
+                matched = matcher.matches(''.join(texts))
+                branch = "true" if matched else "false"
+                slots[slot] = list(targets[branch])
+                # Deactivate everything the branch not taken would have fed, in one step
+                state['skip'] |= self.branch_skips[node.id][branch]
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "condition", matched=matched, targets=slots[slot])
+                write_memory_targets(node, state)
                 return state
             return fn
 
         def query_factory(node: Node):
+            slot = self.slot_of[node.id]
+            inputs = input_slots(node)
+            # Query node content: [behaviour, token budget, budget priority]
+            if len(node.content) > 1 and budget_fields(node.content) is None:
+                self._legacy_content(node)
+            prefix = query_prefix(node.content)
+            packer = PromptPacker.from_content(node.content, self.tokenizer)
+            kinds = [input_kind(i.type) for i in self.graph.get_incoming_edge_nodes(node) if self.reads_input(node, i)]
+
+            def prepare(state: Dict[str, Any]):
+                # Only called for active states: every input ran and every condition routed here
+                slots = state['slots']
+                tokens = None
+                if packer is None:
+                    prompt = prefix + "".join(str(slots[p]) for p in inputs)
+                else:
+                    values = [slots[p] if isinstance(slots[p], str) else str(slots[p]) for p in inputs]
+                    prompt, tokens = packer.pack(prefix, list(zip(kinds, values)))
+                    metrics.prompt_tokens.observe(tokens, graph=self.name, node_id=node.id)
+                metrics.prompt_chars.observe(len(prompt), graph=self.name, node_id=node.id)
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "prompt", chars=len(prompt), tokens=tokens, text=prompt)
+                return prompt
+
+            def finish(state: Dict[str, Any], content):
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "llm_output", chars=len(str(content)), text=content)
+                metrics.response_chars.observe(len(str(content)), graph=self.name, node_id=node.id)
+                state['slots'][slot] = content
+                write_memory_targets(node, state)
+
+            def cached(state: Dict[str, Any], prompt: str) -> bool:
+                if self.response_cache is None:
+                    return False
+                content = self.response_cache.get(self.model_name, prompt)
+                metrics.cache_requests.inc(graph=self.name, cache="response", result="miss" if content is None else "hit")
+                if content is None:
+                    return False
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "response_cache_hit")
+                on_token = state.get('on_token') if node.id in self.stream_nodes else None
+                if on_token is not None:
+                    on_token(content)
+                finish(state, content)
+                return True
+
+            def store(prompt: str, content):
+                if self.response_cache is not None and isinstance(content, str):
+                    self.response_cache.set(self.model_name, prompt, content)
+
+            def first_token(start: float):
+                metrics.phase_seconds.observe(time.perf_counter() - start, graph=self.name, node_id=node.id,
+                                              phase='llm_first_token')
+
             def fn(state: Dict[str, Any]) -> Dict[str, Any]:
-                incoming = self.graph.get_incoming_edge_nodes(node)
-                flag = True
-                for i in incoming:
-                    if i.type != "condition":
-                        if str(i.id) in state['activation'].keys() and not state['activation'][str(i.id)]:
-                            flag = False
-                        elif str(i.id) not in state['activation'].keys():
-                            flag = False
+                prompt = prepare(state)
+                if cached(state, prompt):
+                    return state
+                on_token = state.get('on_token') if node.id in self.stream_nodes else None
+                with phase(node, 'llm'):
+                    if on_token is None:
+                        out = self.llm.invoke([HumanMessage(content=prompt)])
+                        content = out.content
                     else:
-                        if str(node.id) not in state["data"][str(i.id)]:
-                            flag = False
-                if flag:
-                    state["activation"][str(node.id)] = True
-                    inputs = [str(state['data'][str(i.id)]) for i in incoming if i.type != "condition"]
-                    print(f"[Node {node.id} - QUERY] prompt_parts={node.content + inputs}")
-                    prompt = "".join(node.content) + "".join(inputs)
-                    out = self.llm.invoke([HumanMessage(content=prompt)])
-                    print(f"[Node {node.id}] LLM output='{out.content}'")
-                    state['data'][str(node.id)] = out.content
-                    memory_targets = [c.to_node.id for c in self.graph.connections if c.from_node == node and c.to_node.type == 'memory']
-                    for memory_node_id in memory_targets:
-                        file_path = os.path.join(script_dir, f"memory_{memory_node_id}.txt")
-                        try:
-                            with open(file_path, 'a', encoding='utf-8') as f:
-                                f.write(str(state['data'][str(node.id)]) + "\n\n")
-                        except (PermissionError, OSError) as e:
-                            print(f"Error writing to {file_path}: {e}")
-                else:
-                    state["activation"][str(node.id)] = False
+                        parts = []
+                        start = time.perf_counter()
+                        for chunk in self.llm.stream([HumanMessage(content=prompt)]):
+                            if chunk.content:
+                                if not parts:
+                                    first_token(start)
+                                parts.append(chunk.content)
+                                on_token(chunk.content)
+                        content = "".join(parts)
+                store(prompt, content)
+                finish(state, content)
+                return state
+
+            async def afn(state: Dict[str, Any]) -> Dict[str, Any]:
+                prompt = prepare(state)
+                if cached(state, prompt):
+                    return state
+                on_token = state.get('on_token') if node.id in self.stream_nodes else None
+                with phase(node, 'llm'):
+                    if on_token is None:
+                        out = await self.llm.ainvoke([HumanMessage(content=prompt)])
+                        content = out.content
+                    else:
+                        parts = []
+                        start = time.perf_counter()
+                        async for chunk in self.llm.astream([HumanMessage(content=prompt)]):
+                            if chunk.content:
+                                if not parts:
+                                    first_token(start)
+                                parts.append(chunk.content)
+                                on_token(chunk.content)
+                        content = "".join(parts)
+                store(prompt, content)
+                finish(state, content)
+                return state
+
+            def bfn(states: List[Dict[str, Any]]):
+                # Identical prompts across the batch share one LLM call
+                waiting: Dict[str, List[Dict[str, Any]]] = {}
+                for state in states:
+                    prompt = prepare(state)
+                    if not cached(state, prompt):
+                        waiting.setdefault(prompt, []).append(state)
+                if waiting:
+                    prompts = list(waiting)
+                    with phase(node, 'llm'):
+                        outs = self.llm.batch([[HumanMessage(content=p)] for p in prompts],
+                                              config={"max_concurrency": self.batch_concurrency})
+                    for prompt, out in zip(prompts, outs):
+                        store(prompt, out.content)
+                        for state in waiting[prompt]:
+                            finish(state, out.content)
+            return fn, afn, bfn
+
+        def alias_factory(node: Node, source: int):
+            # Structurally identical to an earlier node: reuse its value, keep our own memory writes
+            slot = self.slot_of[node.id]
+            source_slot = self.slot_of[source]
+
+            def fn(state: Dict[str, Any]) -> Dict[str, Any]:
+                slots = state['slots']
+                slots[slot] = slots[source_slot]
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "alias", source=source)
+                write_memory_targets(node, state)
                 return state
             return fn
 
         def memory_factory(node: Node):
+            window = self.memory_window(node)
+            if window is None:
+                # Old memory nodes ignored their content and read the whole log
+                self._legacy_content(node)
+                window = (None, None)
+            max_entries, max_tokens = window
+            slot = self.slot_of[node.id]
+
+            def read(state: Dict[str, Any]):
+                with phase(node, 'memory_read'):
+                    entries = self.memory_store.read_entries(node.id, max_entries, max_tokens, state['session_id'])
+                state['slots'][slot] = Segments(entries, trailing=True)
+                write_memory_targets(node, state)
+
             def fn(state: Dict[str, Any]) -> Dict[str, Any]:
-                file_path = os.path.join(script_dir, f"memory_{node.id}.txt")
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                except FileNotFoundError:
-                    content = ""
-                state['data'][str(node.id)] = content
-                state['activation'][str(node.id)] = True
-                memory_targets = [c.to_node.id for c in self.graph.connections if c.from_node == node and c.to_node.type == 'memory']
-                for memory_node_id in memory_targets:
-                    file_path = os.path.join(script_dir, f"memory_{memory_node_id}.txt")
-                    try:
-                        with open(file_path, 'a', encoding='utf-8') as f:
-                            f.write(str(state['data'][str(node.id)]) + "\n\n")
-                    except (PermissionError, OSError) as e:
-                        print(f"Error writing to {file_path}: {e}")
+                # Every node writing here is an input, so all of its writes are buffered by now
+                self._apply_memory_writes([state], node.id)
+                read(state)
                 return state
-            return fn
+
+            def bfn(states: List[Dict[str, Any]]):
+                # Question by question, as if asked one after another: each one sees
+                # the writes of the questions before it, never those after it
+                for state in states:
+                    self._apply_memory_writes([state], node.id)
+                    read(state)
+            return fn, bfn
 
         def output_factory(node: Node):
+            slot = self.slot_of[node.id]
+            inputs = input_slots(node)
+
             def fn(state: Dict[str, Any]) -> Dict[str, Any]:
-                incoming = self.graph.get_incoming_edge_nodes(node)
-                parts = [state['data'][str(i.id)] for i in incoming if str(i.id) in state['data']]
-                print(f"[Node {node.id} - OUTPUT] parts={parts}")
+                slots = state['slots']
+                parts = [slots[p] for p in inputs if slots[p] is not None]
                 state['answer'] = "".join(parts)
-                state['data'][str(node.id)] = state['answer']
-                state["activation"][str(node.id)] = True
-                memory_targets = [c.to_node.id for c in self.graph.connections if c.from_node == node and c.to_node.type == 'memory']
-                for memory_node_id in memory_targets:
-                    file_path = os.path.join(script_dir, f"memory_{memory_node_id}.txt")
-                    try:
-                        with open(file_path, 'a', encoding='utf-8') as f:
-                            f.write(str(state['data'][str(node.id)]) + "\n\n")
-                    except (PermissionError, OSError) as e:
-                        print(f"Error writing to {file_path}: {e}")
+                trace = detail(state)
+                if trace:
+                    trace.node(node, "output", parts=len(parts), text=state['answer'])
+                slots[slot] = state['answer']
+                write_memory_targets(node, state)
                 return state
             return fn
 
         # Assign functions
+        self.node_funcs, self.async_node_funcs, self.batch_node_funcs = {}, {}, {}
         for node in self.graph.nodes:
-            if node.type == 'input':
+            if node.id in self.aliases:
+                self.node_funcs[node.id] = alias_factory(node, self.aliases[node.id])
+            elif node.type == 'input':
                 self.node_funcs[node.id] = input_factory(node)
             elif node.type == 'retrieval':
-                self.node_funcs[node.id] = retrieval_factory(node)
+                (self.node_funcs[node.id], self.async_node_funcs[node.id],
+                 self.batch_node_funcs[node.id]) = retrieval_factory(node)
             elif node.type == 'query':
-                self.node_funcs[node.id] = query_factory(node)
+                (self.node_funcs[node.id], self.async_node_funcs[node.id],
+                 self.batch_node_funcs[node.id]) = query_factory(node)
             elif node.type == 'condition':
                 self.node_funcs[node.id] = condition_factory(node)
             elif node.type == 'memory':
-                self.node_funcs[node.id] = memory_factory(node)
+                self.node_funcs[node.id], self.batch_node_funcs[node.id] = memory_factory(node)
             elif node.type == 'output':
                 self.node_funcs[node.id] = output_factory(node)
             else:
                 raise ValueError(f"Unsupported node type: {node.type}")
 
-        self.exec_order = self.graph.topological_sort()
+        self.successors = {n.id: [c.to_node.id for c in self.graph.get_outgoing_connections(n)] for n in self.graph.nodes}
+        self.indegree = {n.id: len(self.graph.get_incoming_connections(n)) for n in self.graph.nodes}
+        # An alias runs after the node it copies
+        for nid, source in self.aliases.items():
+            self.successors[source].append(nid)
+            self.indegree[nid] += 1
+        self.parallel_nodes = {n.id for n in self.graph.nodes
+                               if n.type in PARALLEL_NODE_TYPES and n.id not in self.aliases}
+        # A query node that is the first input of an output node produces a prefix
+        # of the answer, so its tokens can be forwarded while it is generating.
+        # An aliased query streams through the node it copies, which yields the same text.
+        self.stream_nodes = set()
+        for n in self.graph.nodes:
+            if n.type == 'output':
+                incoming = self.graph.get_incoming_edge_nodes(n)
+                if incoming and incoming[0].type == 'query':
+                    self.stream_nodes.add(self.aliases.get(incoming[0].id, incoming[0].id))
+        self.chains = self._fuse_chains() if self.optimize else {nid: [nid] for nid in self.exec_order}
+        self.optimization_report = {
+            'aliased': dict(self.aliases),
+            'fused_chains': [chain for chain in self.chains.values() if len(chain) > 1],
+        }
+        if self.optimize:
+            tracer.emit(logging.INFO, "graph_optimized", graph=self.name, nodes=len(self.exec_order),
+                        aliased=len(self.aliases), fused_chains=len(self.optimization_report['fused_chains']),
+                        fused_nodes=sum(len(c) for c in self.optimization_report['fused_chains']))
+
+    @staticmethod
+    def reads_input(node: Node, source: Node) -> bool:
+        # Memory nodes only receive writes, and query/retrieval nodes ignore condition inputs
+        if node.type == 'memory':
+            return False
+        if node.type in GATED_NODE_TYPES:
+            return source.type != 'condition'
+        return True
+
+    # --- Optimizer ---
+    # CSE_NODE_TYPES nodes with the same type, content and ordered incoming
+    # connections produce the same value, so only the first one is executed.
+    CSE_NODE_TYPES = ('query', 'retrieval')
 
-    def ask_question(self, question: str) -> str:
-        state: Dict[str, Any] = {'question': question, 'data': {}, 'activation': {}, 'answer': ''}
-        print(f"Starting workflow for question: '{question}'")
+    def _find_common_nodes(self) -> Dict[int, int]:
+        aliases: Dict[int, int] = {}
+        seen: Dict[tuple, int] = {}
         for nid in self.exec_order:
-            print(f"\n---> Executing node {nid} ({self.graph.get_node_by_id(nid).type})")
-            state = self.node_funcs[nid](state)
-        return str(state['answer'])
-
-def prompt(inp):
-    graph = Graph()
-    workflow = LLMWorkflow(graph, vector_store, llm)
-    workflow.get_graph('graph.json')
-    workflow.build()
-    ans = workflow.ask_question(inp)
+            node = self.graph.get_node_by_id(nid)
+            if node.type not in self.CSE_NODE_TYPES:
+                continue
+            # Inputs are compared after aliasing, so duplicates of duplicates are found too
+            key = (node.type, tuple(node.content),
+                   tuple((aliases.get(c.from_node.id, c.from_node.id), c.output_type)
+                         for c in self.graph.get_incoming_connections(node)))
+            if key in seen:
+                aliases[nid] = seen[key]
+            else:
+                seen[key] = nid
+        return aliases
+
+    def _fuse_chains(self) -> Dict[int, List[int]]:
+        # A node whose only successor has no other input is followed by that
+        # successor in the same scheduled unit: the chain is dispatched once and
+        # runs back to back instead of returning to the scheduler after each node.
+        # Conditions end a chain, so the skip mask is only updated by the scheduler.
+        chains: Dict[int, List[int]] = {}
+        member_of: Dict[int, int] = {}
+        for nid in self.exec_order:
+            head = member_of.get(nid, nid)
+            chain = chains.setdefault(head, [])
+            chain.append(nid)
+            succ = self.successors[nid]
+            if (len(succ) == 1 and self.indegree[succ[0]] == 1 and
+                    self.graph.get_node_by_id(nid).type != 'condition' and
+                    self.graph.get_node_by_id(succ[0]).type != 'condition'):
+                member_of[succ[0]] = head
+        return chains
+
+    def _plan_slots(self):
+        # A request keeps node values in state['slots'], indexed by topological
+        # position. Each slot counts the nodes that read it; when the last of them
+        # has run (or been skipped) the value is dropped, so large retrievals and
+        # memory contents are not held until the request ends.
+        self.slot_of = {nid: i for i, nid in enumerate(self.exec_order)}
+        self.read_slots = {}
+        self.reader_counts = [0] * len(self.exec_order)
+        for node in self.graph.nodes:
+            if node.id in self.aliases:
+                reads = [self.slot_of[self.aliases[node.id]]]
+            else:
+                reads = sorted({self.slot_of[i.id] for i in self.graph.get_incoming_edge_nodes(node)
+                                if self.reads_input(node, i)})
+            self.read_slots[node.id] = reads
+            for p in reads:
+                self.reader_counts[p] += 1
+
+    def _new_state(self, question: str, on_token=None, session_id: str = None, trace=None) -> Dict[str, Any]:
+        return {'question': question, 'slots': [None] * len(self.exec_order), 'uses': list(self.reader_counts),
+                'skip': 0, 'answer': '', 'on_token': on_token, 'session_id': session_id, 'trace': trace,
+                'memory_writes': {}}
+
+    def _apply_memory_writes(self, states: List[Dict[str, Any]], target: int = None):
+        # Append the buffered writes to target (None: to every memory node still
+        # pending) ordered by the writers' topological position; within a batch,
+        # question by question, the order sequential requests would write in
+        targets = [target] if target is not None else sorted({t for state in states for t in state['memory_writes']})
+        for memory_node_id in targets:
+            for state in states:
+                for _, text in sorted(state['memory_writes'].pop(memory_node_id, ()), key=lambda w: w[0]):
+                    self.memory_store.append(memory_node_id, text, state['session_id'])
+
+    def _consume(self, nid: int, state: Dict[str, Any]):
+        # Called once nid has run or been skipped
+        slots, uses = state['slots'], state['uses']
+        for p in self.read_slots[nid]:
+            uses[p] -= 1
+            if uses[p] == 0:
+                slots[p] = None
+        own = self.slot_of[nid]
+        if uses[own] == 0:
+            slots[own] = None
+
+    def _plan_activation(self):
+        # Bit i of a request's skip mask marks exec_order[i] as inactive. Query and
+        # retrieval nodes only run when every non-condition input ran, and query
+        # nodes also need each incoming condition to route to them; so the nodes a
+        # condition deactivates are fixed per branch and precomputed here as masks.
+        self.node_bits = {nid: 1 << i for nid, i in self.slot_of.items()}
+        self.branch_skips = {}
+        for node in self.graph.nodes:
+            if node.type != 'condition':
+                continue
+            outgoing = self.graph.get_outgoing_connections(node)
+            self.branch_skips[node.id] = {}
+            for branch in ("true", "false"):
+                routed = {c.to_node.id for c in outgoing if c.output_type == branch}
+                seeds = [c.to_node for c in outgoing if c.to_node.type == 'query' and c.to_node.id not in routed]
+                self.branch_skips[node.id][branch] = self._downstream_mask(seeds)
+
+    def _downstream_mask(self, seeds: List[Node]) -> int:
+        # The seeds plus every gated node that (transitively) takes one of them as input
+        mask = 0
+        stack = list(seeds)
+        while stack:
+            node = stack.pop()
+            bit = self.node_bits[node.id]
+            if mask & bit:
+                continue
+            mask |= bit
+            for c in self.graph.get_outgoing_connections(node):
+                if c.to_node.type in GATED_NODE_TYPES:
+                    stack.append(c.to_node)
+        return mask
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # One pool per compiled workflow, shared by all concurrent requests; each
+        # request keeps at most max_workers chains in it (see _run_parallel).
+        # Pool threads do not survive fork, so a forked worker starts its own pool
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="llmworkflow")
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _observe_node(self, node: Node, mode: str, start: float, trace, **fields):
+        elapsed = time.perf_counter() - start
+        metrics.node_seconds.observe(elapsed, graph=self.name, node_id=node.id, node_type=node.type, mode=mode)
+        metrics.node_type_seconds.observe(elapsed, graph=self.name, node_type=node.type, mode=mode)
+        if trace is not None:
+            trace.node(node, "node_done", ms=round(elapsed * 1000, 2), **fields)
+
+    def _run_node(self, nid: int, state: Dict[str, Any], mode: str = "single"):
+        if state['skip'] & self.node_bits[nid]:
+            return
+        node = self.graph.get_node_by_id(nid)
+        start = time.perf_counter()
+        try:
+            self.node_funcs[nid](state)
+        finally:
+            self._observe_node(node, mode, start, state['trace'])
+
+    def _release(self, nid: int, remaining: Dict[int, int], ready: deque):
+        for succ in self.successors[nid]:
+            remaining[succ] -= 1
+            if remaining[succ] == 0:
+                ready.append(succ)
+
+    def _run_parallel(self, run, live, finished):
+        # Ready-queue scheduler: a chain of nodes (see _fuse_chains) is dispatched
+        # as soon as all incoming connections of its head have completed, so
+        # independent branches overlap. run(nid) executes one node, for a single
+        # state or a whole batch; nodes for which live(nid) is False are skipped.
+        # finished(nid) is called once nid has run or been skipped: on this thread
+        # for a chain head, on the chain's thread for the other members, which
+        # only read the slot of the member before them.
+        # A chain that is the only work left runs here, on the request thread; the
+        # pool only takes chains that overlap, at most max_workers at a time.
+        remaining = dict(self.indegree)
+        ready = deque(nid for nid in self.exec_order if remaining[nid] == 0)
+        waiting = deque()
+        pending = {}
+        executor = self._get_executor()
+        stop = threading.Event()
+
+        def run_chain(chain: List[int]):
+            for i, nid in enumerate(chain):
+                if stop.is_set():
+                    return
+                if live(nid):
+                    run(nid)
+                if i:
+                    finished(nid)
+
+        def complete(chain: List[int]):
+            finished(chain[0])
+            self._release(chain[-1], remaining, ready)
+
+        try:
+            while ready or waiting or pending:
+                while ready:
+                    chain = self.chains[ready.popleft()]
+                    if any(nid in self.parallel_nodes and live(nid) for nid in chain):
+                        waiting.append(chain)
+                    else:
+                        run_chain(chain)
+                        complete(chain)
+                if len(waiting) == 1 and not pending:
+                    chain = waiting.popleft()
+                    run_chain(chain)
+                    complete(chain)
+                    continue
+                while waiting and len(pending) < self.max_workers:
+                    chain = waiting.popleft()
+                    pending[executor.submit(run_chain, chain)] = chain
+                if pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        chain = pending.pop(future)
+                        future.result()
+                        complete(chain)
+        finally:
+            # On failure, nothing of this request may keep running (or writing
+            # memory) after the caller has flushed and raised
+            stop.set()
+            for future in pending:
+                future.cancel()
+            wait(pending)
+
+    def _run_node_batch(self, nid: int, states: List[Dict[str, Any]]):
+        bit = self.node_bits[nid]
+        states = [state for state in states if not state['skip'] & bit]
+        if not states:
+            return
+        node = self.graph.get_node_by_id(nid)
+        start = time.perf_counter()
+        try:
+            if nid in self.batch_node_funcs:
+                self.batch_node_funcs[nid](states)
+            else:
+                for state in states:
+                    self.node_funcs[nid](state)
+        finally:
+            self._observe_node(node, "batch", start, states[0]['trace'], questions=len(states))
+
+    async def _run_chain_async(self, chain: List[int], state: Dict[str, Any]):
+        # The head is consumed by the caller once the whole chain is done
+        for i, nid in enumerate(chain):
+            if nid in self.async_node_funcs and not state['skip'] & self.node_bits[nid]:
+                await self._run_node_async(nid, state)
+            else:
+                self._run_node(nid, state, "async")
+            if i:
+                self._consume(nid, state)
+
+    async def _run_node_async(self, nid: int, state: Dict[str, Any]):
+        node = self.graph.get_node_by_id(nid)
+        start = time.perf_counter()
+        try:
+            await self.async_node_funcs[nid](state)
+        finally:
+            self._observe_node(node, "async", start, state['trace'])
+
+    def _flush_memory(self, session_id: str = None):
+        with metrics.memory_flush_seconds.time(graph=self.name):
+            self.memory_store.flush(session_id)
+
+    def _trace_failure(self, trace, mode: str, error: Exception, **fields):
+        # Failures are logged whether or not the request was sampled
+        tracer.emit(logging.ERROR, "request_failed", request=trace.request_id if trace is not None else None,
+                    graph=self.name, mode=mode, error=repr(error), **fields)
+
+    def ask_question(self, question: str, on_token=None, session_id: str = None) -> str:
+        trace = tracer.start()
+        state = self._new_state(question, on_token, session_id, trace)
+        with metrics.request_seconds.time(graph=self.name, mode="single"):
+            try:
+                if self.max_workers > 1:
+                    self._run_parallel(lambda nid: self._run_node(nid, state),
+                                       lambda nid: not state['skip'] & self.node_bits[nid],
+                                       lambda nid: self._consume(nid, state))
+                else:
+                    for nid in self.exec_order:
+                        self._run_node(nid, state)
+                        self._consume(nid, state)
+            except Exception as e:
+                self._trace_failure(trace, "single", e, question=question)
+                raise
+            finally:
+                self._apply_memory_writes([state])
+                self._flush_memory(session_id)
+        answer = str(state['answer'])
+        if trace is not None:
+            trace.info("request", graph=self.name, mode="single", question=question, answer_chars=len(answer))
+        return answer
+
+    def ask_questions(self, questions: List[str], session_ids: List[str] = None) -> List[str]:
+        # Runs the DAG once for the whole batch: every node processes all questions
+        # before its successors start, so query nodes make one llm.batch call and
+        # retrieval nodes one embedding request plus one FAISS matrix search.
+        # Memory nodes read question by question, so a question sees the memory
+        # writes of the earlier questions in its session, as if asked in order.
+        if session_ids is None:
+            session_ids = [None] * len(questions)
+        # The whole batch is sampled, and traced, as one request
+        trace = tracer.start()
+        states = [self._new_state(q, session_id=sid, trace=trace) for q, sid in zip(questions, session_ids)]
+
+        def finished(nid: int):
+            for state in states:
+                self._consume(nid, state)
+
+        with metrics.request_seconds.time(graph=self.name, mode="batch"):
+            try:
+                if self.max_workers > 1:
+                    self._run_parallel(lambda nid: self._run_node_batch(nid, states),
+                                       lambda nid: any(not state['skip'] & self.node_bits[nid] for state in states),
+                                       finished)
+                else:
+                    for nid in self.exec_order:
+                        self._run_node_batch(nid, states)
+                        finished(nid)
+            except Exception as e:
+                self._trace_failure(trace, "batch", e, questions=len(states))
+                raise
+            finally:
+                self._apply_memory_writes(states)
+                for session_id in set(session_ids):
+                    self._flush_memory(session_id)
+        answers = [str(state['answer']) for state in states]
+        if trace is not None:
+            trace.info("request", graph=self.name, mode="batch", questions=len(states),
+                       answer_chars=sum(len(a) for a in answers))
+        return answers
+
+    def ask_question_stream(self, question: str, session_id: str = None):
+        # Runs the workflow on a background thread and yields ("token", text)
+        # events from the streaming query node, then ("answer", full_answer) or
+        # ("error", message). Tokens are always a prefix of the final answer.
+        events = queue.Queue()
+        done = object()
+
+        def run():
+            try:
+                answer = self.ask_question(question, on_token=lambda text: events.put(("token", text)),
+                                           session_id=session_id)
+                events.put(("answer", answer))
+            except Exception as e:
+                events.put(("error", str(e)))
+            finally:
+                events.put(done)
+
+        threading.Thread(target=run, daemon=True).start()
+        while True:
+            event = events.get()
+            if event is done:
+                return
+            yield event
+
+    async def ask_question_async(self, question: str, on_token=None, session_id: str = None) -> str:
+        # Same ready-queue scheduling as _run_parallel, but query/retrieval nodes
+        # are awaited as tasks on the running event loop instead of pool threads.
+        trace = tracer.start()
+        state = self._new_state(question, on_token, session_id, trace)
+        remaining = dict(self.indegree)
+        ready = deque(nid for nid in self.exec_order if remaining[nid] == 0)
+        pending = {}
+
+        def complete(chain: List[int]):
+            self._consume(chain[0], state)
+            self._release(chain[-1], remaining, ready)
+
+        with metrics.request_seconds.time(graph=self.name, mode="async"):
+            try:
+                while ready or pending:
+                    while ready:
+                        chain = self.chains[ready.popleft()]
+                        if any(nid in self.async_node_funcs and not state['skip'] & self.node_bits[nid]
+                               for nid in chain):
+                            pending[asyncio.ensure_future(self._run_chain_async(chain, state))] = chain
+                        else:
+                            for i, nid in enumerate(chain):
+                                self._run_node(nid, state, "async")
+                                if i:
+                                    self._consume(nid, state)
+                            complete(chain)
+                    if pending:
+                        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            chain = pending.pop(task)
+                            task.result()
+                            complete(chain)
+            except Exception as e:
+                self._trace_failure(trace, "async", e, question=question)
+                raise
+            finally:
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+                self._apply_memory_writes([state])
+                self._flush_memory(session_id)
+        answer = str(state['answer'])
+        if trace is not None:
+            trace.info("request", graph=self.name, mode="async", question=question, answer_chars=len(answer))
+        return answer
+
+# --- Compiled Workflow Cache ---
+# Built workflows keyed by absolute graph path. Each entry remembers the file's
+# (mtime, size) stamp and content hash, so an unchanged graph.json is neither
+# re-parsed nor rebuilt, and a touched-but-identical file only costs one hash.
+_workflow_cache: Dict[str, Dict[str, Any]] = {}
+_workflow_cache_lock = threading.Lock()
+
+def _graph_file_stamp(path: str):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _graph_file_digest(path: str):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+def get_workflow(path: str = 'graph.json') -> LLMWorkflow:
+    abs_path = os.path.abspath(path)
+    with _workflow_cache_lock:
+        stamp = _graph_file_stamp(abs_path)
+        cached = _workflow_cache.get(abs_path)
+        if cached is not None and cached['stamp'] == stamp:
+            return cached['workflow']
+        digest = _graph_file_digest(abs_path)
+        if cached is not None and cached['digest'] == digest:
+            cached['stamp'] = stamp
+            return cached['workflow']
+        graph = Graph()
+        workflow = LLMWorkflow(graph, response_cache=response_cache, retrieval_cache=retrieval_cache,
+                               memory_store=shared_memory_store, name=path)
+        workflow.get_graph(abs_path)
+        workflow.build()
+        _workflow_cache[abs_path] = {'stamp': stamp, 'digest': digest, 'workflow': workflow}
+        return workflow
+
+def reinit_clients():
+    # Network clients (gRPC/HTTP sessions) are not fork-safe: a pre-forking server
+    # calls this in each worker so only the FAISS index and compiled graphs are
+    # shared with the parent, while connections are reopened lazily per process.
+    with _resources_lock:
+        if 'llm' not in _injected:
+            _resources['llm'] = None
+        embeddings = _resources['embeddings']
+        if 'embeddings' not in _injected and embeddings is not None:
+            from langchain_google_genai import GoogleGenerativeAIEmbeddings
+            embeddings.underlying = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL)
+
+def clear_workflow_cache():
+    with _workflow_cache_lock:
+        _workflow_cache.clear()
+
+def prompt(inp, graph_path: str = 'graph.json', session_id: str = None):
+    workflow = get_workflow(graph_path)
+    ans = workflow.ask_question(inp, session_id=session_id)
     return ans
 
+def prompt_stream(inp, graph_path: str = 'graph.json', session_id: str = None):
+    workflow = get_workflow(graph_path)
+    yield from workflow.ask_question_stream(inp, session_id=session_id)
+
+def prompt_batch(inputs: List[str], graph_path: str = 'graph.json', session_ids: List[str] = None,
+                 chunk_size: int = 32):
+    # Yields (index, answer) pairs chunk by chunk so callers can forward answers
+    # while the rest of the batch is still running.
+    workflow = get_workflow(graph_path)
+    if session_ids is None:
+        session_ids = [None] * len(inputs)
+    for start in range(0, len(inputs), chunk_size):
+        answers = workflow.ask_questions(inputs[start:start + chunk_size], session_ids[start:start + chunk_size])
+        for offset, answer in enumerate(answers):
+            yield start + offset, answer
+
+async def prompt_async(inp, graph_path: str = 'graph.json', session_id: str = None):
+    workflow = get_workflow(graph_path)
+    return await workflow.ask_question_async(inp, session_id=session_id)
+
 if __name__ == '__main__':
     prompt("Hello who are you")
     pass
     #graph = Graph()
-    #workflow = LLMWorkflow(graph, vector_store, llm)
+    #workflow = LLMWorkflow(graph, get_vector_store(), get_llm())
     #workflow.get_graph('graph.json')
     #workflow.build()
     #workflow.clear_memory()
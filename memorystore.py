@@ -0,0 +1,242 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+from tracing import tracer
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are still serialized within the process
+    fcntl = None
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def session_dir_name(session_id: str) -> str:
+    # Keep readable ids as-is, hash anything that is not safe as a directory name
+    if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", session_id):
+        return session_id
+    return hashlib.sha256(session_id.encode('utf-8')).hexdigest()[:32]
+
+# --- Log Format ---
+# Legacy logs hold each entry followed by a blank line, which cannot tell an
+# entry's own blank lines from the separator. Logs written now start with
+# LOG_MARKER (or continue with it, after the legacy entries of an older log) and
+# then hold one JSON string per line, so any text reads back as written.
+LOG_MARKER = b"\x1ememory log v2\n"
+
+
+def parse_legacy(data: bytes) -> List[str]:
+    text = data.decode('utf-8').replace("\r\n", "\n").replace("\r", "\n")
+    parts = text.split("\n\n")
+    if parts and parts[-1] == "":
+        parts.pop()
+    return parts
+
+
+def parse_records(data: bytes) -> Tuple[List[str], int]:
+    # A line still being written by another process is left for the next read
+    end = data.rfind(b"\n") + 1
+    return [json.loads(line) for line in data[:end].split(b"\n") if line], end
+
+
+def encode_records(texts: List[str]) -> bytes:
+    return "".join(json.dumps(text, ensure_ascii=False) + "\n" for text in texts).encode('utf-8')
+
+# --- Memory Store ---
+class MemoryStore:
+    """In-process buffer for memory nodes backed by append-only memory_{id}.txt logs.
+
+    Each entry is kept with its token count so a bounded window (last N entries
+    and/or last N tokens) is read in O(window). Appends are visible immediately;
+    the disk log is only written by flush(), once per request.
+
+    Memory is namespaced by session: session None uses the legacy files in
+    directory, any other session id gets its own sessions/<id>/ subdirectory.
+    (session, node) logs are locked through a fixed pool of locks, and only the
+    bytes a log gained on disk behind our back (another worker process) are
+    read before it is used. At most max_logs logs are cached; the least
+    recently used ones without unflushed entries are dropped beyond that.
+    """
+
+    def __init__(self, directory: str, token_counter: Callable[[str], int] = count_words,
+                 max_logs: int = 1024, lock_count: int = 64):
+        self.directory = directory
+        self.token_counter = token_counter
+        self.max_logs = max_logs
+        self._entries: Dict[tuple, List[Tuple[str, int]]] = {}
+        self._disk_sizes: Dict[tuple, int] = {}
+        self._marked: Dict[tuple, bool] = {}
+        self._pending: Dict[tuple, List[str]] = {}
+        self._locks = [threading.Lock() for _ in range(lock_count)]
+        self._recent: "OrderedDict[tuple, None]" = OrderedDict()
+        self._recent_guard = threading.Lock()
+
+    def path(self, node_id: int, session_id: Optional[str] = None) -> str:
+        if session_id is None:
+            return os.path.join(self.directory, f"memory_{node_id}.txt")
+        return os.path.join(self.directory, "sessions", session_dir_name(session_id), f"memory_{node_id}.txt")
+
+    def _lock(self, key: tuple) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    def _touch(self, key: tuple):
+        with self._recent_guard:
+            self._recent[key] = None
+            self._recent.move_to_end(key)
+            if len(self._recent) <= self.max_logs:
+                return
+            for old in list(self._recent):
+                if len(self._recent) <= self.max_logs:
+                    break
+                if old == key or self._pending.get(old):
+                    continue
+                # Never wait here: the caller holds its own log's lock
+                lock = self._lock(old)
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    if not self._pending.get(old):
+                        del self._recent[old]
+                        self._entries.pop(old, None)
+                        self._disk_sizes.pop(old, None)
+                        self._marked.pop(old, None)
+                finally:
+                    lock.release()
+
+    def _insert_disk_entries(self, key: tuple, entries: List[Tuple[str, int]], texts: List[str]):
+        # Entries read from disk go before this process's unflushed ones
+        at = len(entries) - len(self._pending.get(key, ()))
+        entries[at:at] = [(t, self.token_counter(t)) for t in texts]
+
+    def _disk_size(self, key: tuple) -> int:
+        try:
+            return os.path.getsize(self.path(key[1], key[0]))
+        except FileNotFoundError:
+            return 0
+
+    def _load(self, key: tuple) -> List[Tuple[str, int]]:
+        # Caller holds the key's lock. _disk_sizes holds the bytes parsed so far.
+        entries = self._entries.get(key)
+        size = self._disk_size(key)
+        consumed = self._disk_sizes.get(key)
+        if entries is not None and size != consumed and self._marked.get(key) and size > consumed:
+            # Records were appended: parse only those
+            with open(self.path(key[1], key[0]), 'rb') as f:
+                f.seek(consumed)
+                texts, end = parse_records(f.read())
+            self._insert_disk_entries(key, entries, texts)
+            self._disk_sizes[key] = consumed + end
+        elif entries is None or size != consumed:
+            try:
+                with open(self.path(key[1], key[0]), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                data = b""
+            legacy, marker, records = data.partition(LOG_MARKER)
+            texts = parse_legacy(legacy)
+            consumed = len(legacy)
+            if marker:
+                parsed, end = parse_records(records)
+                texts.extend(parsed)
+                consumed += len(marker) + end
+            entries = [(p, self.token_counter(p)) for p in texts]
+            entries.extend((p, self.token_counter(p)) for p in self._pending.get(key, []))
+            self._entries[key] = entries
+            self._disk_sizes[key] = consumed
+            self._marked[key] = bool(marker)
+        self._touch(key)
+        return entries
+
+    def append(self, node_id: int, text: str, session_id: Optional[str] = None):
+        key = (session_id, node_id)
+        with self._lock(key):
+            self._load(key).append((text, self.token_counter(text)))
+            self._pending.setdefault(key, []).append(text)
+
+    def read(self, node_id: int, max_entries: Optional[int] = None, max_tokens: Optional[int] = None,
+             session_id: Optional[str] = None) -> str:
+        return "".join(text + "\n\n" for text in self.read_entries(node_id, max_entries, max_tokens, session_id))
+
+    def read_entries(self, node_id: int, max_entries: Optional[int] = None, max_tokens: Optional[int] = None,
+                     session_id: Optional[str] = None) -> List[str]:
+        key = (session_id, node_id)
+        with self._lock(key):
+            entries = self._load(key)
+            if max_entries is None and max_tokens is None:
+                return [text for text, _ in entries]
+            window = []
+            tokens = 0
+            for text, n in reversed(entries):
+                if max_entries is not None and len(window) >= max_entries:
+                    break
+                if max_tokens is not None and tokens + n > max_tokens:
+                    break
+                window.append(text)
+                tokens += n
+        window.reverse()
+        return window
+
+    def flush(self, session_id: Optional[str] = None):
+        for key in [k for k in list(self._pending) if k[0] == session_id]:
+            with self._lock(key):
+                texts = self._pending.pop(key, None)
+                if not texts:
+                    continue
+                file_path = self.path(key[1], key[0])
+                try:
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    data = encode_records(texts)
+                    with open(file_path, 'a+b') as f:
+                        if fcntl is not None:
+                            fcntl.flock(f, fcntl.LOCK_EX)
+                        end = f.seek(0, os.SEEK_END)
+                        known = self._disk_sizes.get(key)
+                        marked = self._marked.get(key, False) and known is not None and end >= known
+                        if not marked and end:
+                            f.seek(0)
+                            marked = LOG_MARKER in f.read()
+                        if not marked:
+                            data = LOG_MARKER + data
+                        caught_up = end == known and self._marked.get(key, False) == marked
+                        entries = self._entries.get(key)
+                        if not caught_up and marked and self._marked.get(key) and entries is not None \
+                                and known is not None and end > known:
+                            # Another process appended records since our last read
+                            f.seek(known)
+                            foreign = f.read(end - known)
+                            parsed, used = parse_records(foreign)
+                            if used == len(foreign):
+                                at = len(entries) - len(texts)
+                                entries[at:at] = [(t, self.token_counter(t)) for t in parsed]
+                                caught_up = True
+                        f.write(data)
+                    if caught_up:
+                        self._disk_sizes[key] = end + len(data)
+                        self._marked[key] = True
+                    else:
+                        # The log changed some other way: read it again on next use
+                        self._entries.pop(key, None)
+                        self._disk_sizes.pop(key, None)
+                except (PermissionError, OSError) as e:
+                    tracer.emit(logging.WARNING, "memory_write_failed", path=file_path, error=repr(e))
+
+    def clear(self, node_id: int, session_id: Optional[str] = None):
+        key = (session_id, node_id)
+        with self._lock(key):
+            self._entries[key] = []
+            self._pending.pop(key, None)
+            file_path = self.path(node_id, session_id)
+            if session_id is not None and not os.path.exists(file_path):
+                return
+            with open(file_path, 'w', encoding='utf-8'):
+                pass
+            self._disk_sizes[key] = 0
+            self._marked[key] = False
+            self._touch(key)
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import glob
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from tracing import tracer
+
+# --- Buckets ---
+# Seconds, from a cache hit or memory read up to a slow LLM call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Characters of prompt / response text
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+# --- Metric Families ---
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"type": "counter", "samples": [[list(k), v] for k, v in self._values.items()]}
+
+    def merge(self, data: dict):
+        with self._lock:
+            for key, value in data["samples"]:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0) + value
+
+    def render(self, samples) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(samples, key=lambda s: s[0]):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, tuple(key))} {_format_value(value)}")
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"type": "histogram",
+                    "samples": [[list(k), [list(v[0]), v[1], v[2]]] for k, v in self._values.items()]}
+
+    def merge(self, data: dict):
+        with self._lock:
+            for key, (counts, total, count) in data["samples"]:
+                key = tuple(key)
+                entry = self._values.get(key)
+                if entry is None:
+                    entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                for i, c in enumerate(counts):
+                    entry[0][i] += c
+                entry[1] += total
+                entry[2] += count
+
+    def render(self, samples) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(samples, key=lambda s: s[0]):
+            key = tuple(key)
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+# --- Registry ---
+class MetricsRegistry:
+    """Process-wide set of metric families rendered in the Prometheus text format.
+
+    A pre-forked server has one registry per worker. After enable_multiprocess(),
+    every worker periodically writes its samples to directory and render() adds
+    up the files of all workers, so any worker can answer a scrape.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self.directory: Optional[str] = None
+        self._flusher = None
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labelnames, buckets)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {m.name: m.snapshot() for m in metrics}
+
+    def reset(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for m in metrics:
+            m.reset()
+
+    # --- Multi-process Aggregation ---
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.directory, f"metrics_{os.getpid()}.json")
+
+    def write_snapshot(self):
+        path = self._snapshot_path()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def enable_multiprocess(self, directory: str, interval: float = 5.0):
+        # Call in each worker after fork. Files of exited workers are kept so their
+        # counts stay in the totals; clear the directory before starting the server.
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.reset()
+
+        def flush_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_snapshot()
+                except OSError as e:
+                    tracer.emit(logging.WARNING, "metrics_snapshot_failed", directory=self.directory, error=repr(e))
+
+        self._flusher = threading.Thread(target=flush_loop, daemon=True, name="metrics-flush")
+        self._flusher.start()
+
+    def _collect(self) -> Dict[str, list]:
+        if self.directory is None:
+            return {name: data["samples"] for name, data in self.snapshot().items()}
+        self.write_snapshot()
+        merged: Dict[str, object] = {}
+        for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, family in data.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                if name not in merged:
+                    merged[name] = type(metric)(metric.name, metric.help, metric.labelnames,
+                                                *((metric.buckets,) if isinstance(metric, Histogram) else ()))
+                merged[name].merge(family)
+        return {name: m.snapshot()["samples"] for name, m in merged.items()}
+
+    def render(self) -> str:
+        samples = self._collect()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.extend(m.render(samples.get(m.name, [])))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# --- Workflow Metrics ---
+# Every latency is labelled with the graph it came from; node level series also
+# carry the node id, so a slow node can be found in a specific graph.json.
+request_seconds = registry.histogram(
+    "llmgraph_request_seconds", "Time to answer one question (batch: one whole batch).", ("graph", "mode"))
+node_type_seconds = registry.histogram(
+    "llmgraph_node_type_seconds", "Node execution time by node type (batch: one whole batch).",
+    ("graph", "node_type", "mode"))
+node_seconds = registry.histogram(
+    "llmgraph_node_seconds", "Node execution time by node id (batch: one whole batch).",
+    ("graph", "node_id", "node_type", "mode"))
+phase_seconds = registry.histogram(
+    "llmgraph_phase_seconds", "Time of one call inside a node: embedding, faiss_search, lexical_search, "
+    "llm, llm_first_token (streaming), memory_read.", ("graph", "node_id", "phase"))
+memory_flush_seconds = registry.histogram(
+    "llmgraph_memory_flush_seconds", "Time to write a request's memory entries to disk.", ("graph",))
+prompt_chars = registry.histogram(
+    "llmgraph_prompt_chars", "Characters sent to the LLM per query node call.", ("graph", "node_id"), SIZE_BUCKETS)
+prompt_tokens = registry.histogram(
+    "llmgraph_prompt_tokens", "Tokens sent to the LLM per call of a query node with a token budget.",
+    ("graph", "node_id"), SIZE_BUCKETS)
+response_chars = registry.histogram(
+    "llmgraph_response_chars", "Characters returned by the LLM (or response cache) per query node call.",
+    ("graph", "node_id"), SIZE_BUCKETS)
+cache_requests = registry.counter(
+    "llmgraph_cache_requests_total", "Response and retrieval cache lookups by result.", ("graph", "cache", "result"))
@@ -0,0 +1,195 @@
+import os
+import re
+import logging
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from tracing import tracer
+
+# --- Prompt Budget ---
+# A query node can cap the tokens it sends: its content is [behaviour, token
+# budget, priority], and a blank budget means unbounded. The behaviour text and
+# the question (input node) are always sent whole. The rest of the budget goes
+# to the other inputs, kind by kind in priority order (default "retrieval,
+# memory, query"):
+#   retrieval  top-ranked chunks first; a chunk is kept whole or dropped
+#   memory     newest entries first, stopping at the first one that does not fit
+#   query      text of any other upstream node, cut at the end
+# Inputs stay in connection order in the prompt; only their content shrinks.
+# Query nodes from before budgets joined all of their content into the prompt,
+# and the configurator used to append dropped .txt files as extra fields: content
+# that is not a valid [behaviour, budget, priority] layout keeps that meaning.
+
+# Hugging Face tokenizer used to count prompt tokens. Gemini's own tokenizer is
+# not published; a public one is close enough to keep prompt sizes predictable.
+PROMPT_TOKENIZER = os.environ.get("PROMPT_TOKENIZER", "gpt2")
+
+KINDS = ("retrieval", "memory", "query")
+
+_WORD_RE = re.compile(r"\S+")
+
+
+def budget_fields(content: List[str]) -> Optional[Tuple[str, List[str]]]:
+    """(budget, priority kinds) of query content laid out as [behaviour, budget, priority], else None."""
+    if len(content) > 3:
+        return None
+    budget = content[1].strip() if len(content) > 1 and content[1] else ""
+    priority = content[2].strip().lower() if len(content) > 2 and content[2] else ""
+    kinds = re.split(r"[\s,]+", priority) if priority else []
+    if (budget and not budget.isdigit()) or any(kind not in KINDS for kind in kinds):
+        return None
+    return budget, kinds
+
+
+def query_prefix(content: List[str]) -> str:
+    if budget_fields(content) is None:
+        return "".join(content)
+    return content[0] if content else ""
+
+
+def input_kind(node_type: str) -> str:
+    if node_type in ("input", "retrieval", "memory"):
+        return node_type
+    return "query"
+
+# --- Tokenizers ---
+class WordTokenizer:
+    """Counts whitespace-separated words, the fallback when no tokenizer can be loaded."""
+
+    name = "words"
+
+    def count(self, text: str) -> int:
+        return len(text.split())
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if max_tokens <= 0:
+            return ""
+        end = 0
+        for i, m in enumerate(_WORD_RE.finditer(text)):
+            if i == max_tokens:
+                return text[:end]
+            end = m.end()
+        return text
+
+
+class HFTokenizer:
+    def __init__(self, name: str, cache_size: int = 4096):
+        from transformers import AutoTokenizer
+        self.name = name
+        self.tokenizer = AutoTokenizer.from_pretrained(name)
+        # Memory entries and chunks come back request after request
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if max_tokens <= 0:
+            return ""
+        offsets = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        if len(offsets) <= max_tokens:
+            return text
+        return text[:offsets[max_tokens - 1][1]]
+
+
+_tokenizers: Dict[str, Any] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(name: Optional[str] = None):
+    # Loaded on first use, since importing transformers takes seconds. Falls back
+    # to word counts when transformers or the tokenizer files are not available.
+    name = name or PROMPT_TOKENIZER
+    with _tokenizers_lock:
+        tokenizer = _tokenizers.get(name)
+        if tokenizer is None:
+            if name == WordTokenizer.name:
+                tokenizer = WordTokenizer()
+            else:
+                try:
+                    tokenizer = HFTokenizer(name)
+                except Exception as e:
+                    tracer.emit(logging.WARNING, "tokenizer_unavailable", tokenizer=name, error=repr(e))
+                    tokenizer = WordTokenizer()
+            _tokenizers[name] = tokenizer
+    return tokenizer
+
+# --- Segmented Values ---
+class Segments(str):
+    """Text joined from separate items (memory entries, retrieved chunks).
+
+    Behaves as the joined string everywhere; the prompt packer uses items to
+    drop whole entries or chunks instead of cutting through one.
+    """
+
+    def __new__(cls, items: List[str], sep: str = "\n\n", trailing: bool = False):
+        value = super().__new__(cls, cls.join(items, sep, trailing))
+        value.items = list(items)
+        value.sep = sep
+        value.trailing = trailing
+        return value
+
+    @staticmethod
+    def join(items: List[str], sep: str, trailing: bool) -> str:
+        return "".join(item + sep for item in items) if trailing else sep.join(items)
+
+    def subset(self, items: List[str]) -> str:
+        return self.join(items, self.sep, self.trailing)
+
+# --- Prompt Packer ---
+class PromptPacker:
+    def __init__(self, max_tokens: int, priority: Sequence[str] = KINDS, tokenizer=None):
+        self.max_tokens = max_tokens
+        self.priority = tuple(priority)
+        self._tokenizer = tokenizer
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer()
+        return self._tokenizer
+
+    @classmethod
+    def from_content(cls, content: List[str], tokenizer=None) -> Optional["PromptPacker"]:
+        fields = budget_fields(content)
+        if fields is None or not fields[0]:
+            return None
+        budget, priority = fields
+        # Kinds left out are filled last, in the default order
+        priority = list(dict.fromkeys(priority + list(KINDS)))
+        return cls(int(budget), priority, tokenizer)
+
+    def pack(self, prefix: str, inputs: List[Tuple[str, str]]) -> Tuple[str, int]:
+        """Join prefix and (kind, value) inputs within the budget; returns (prompt, tokens)."""
+        tokenizer = self.tokenizer
+        remaining = self.max_tokens - tokenizer.count(prefix)
+        kept: List[Optional[str]] = [None] * len(inputs)
+        for i, (kind, value) in enumerate(inputs):
+            if kind == "input":
+                kept[i] = value
+                remaining -= tokenizer.count(value)
+        for kind in self.priority:
+            for i, (k, value) in enumerate(inputs):
+                if k != kind:
+                    continue
+                items = getattr(value, "items", None)
+                if items is None:
+                    n = tokenizer.count(value)
+                    if n <= remaining:
+                        kept[i] = value
+                        remaining -= n
+                    else:
+                        kept[i] = tokenizer.truncate(value, remaining)
+                        remaining -= tokenizer.count(kept[i])
+                    continue
+                chosen = set()
+                order = range(len(items) - 1, -1, -1) if kind == "memory" else range(len(items))
+                for j in order:
+                    n = tokenizer.count(items[j])
+                    if n <= remaining:
+                        chosen.add(j)
+                        remaining -= n
+                    elif kind == "memory":
+                        break
+                kept[i] = value.subset([items[j] for j in sorted(chosen)])
+        return prefix + "".join(kept), self.max_tokens - remaining
@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+from typing import Optional
+
+# --- Workflow Tracing ---
+# Replaces the unconditional prints of the workflow engine. Configured from the
+# environment (or configure() at runtime):
+#   LLMGRAPH_TRACE_LEVEL        DEBUG (per-node events and payloads), INFO (one line
+#                               per request, the default), WARNING, ERROR
+#   LLMGRAPH_TRACE_SAMPLE_RATE  share of requests that are traced at all (0-1, default 1)
+#   LLMGRAPH_TRACE_MAX_CHARS    payloads (prompts, documents, answers) are cut to this
+#                               many characters (default 200)
+#   LLMGRAPH_TRACE_FULL         1 = trace every request at DEBUG with untruncated
+#                               payloads, and dump the graph JSON when it is loaded
+#   LLMGRAPH_TRACE_FORMAT       text (default) or json (one object per line)
+# Failed requests are always logged, whatever the sampling.
+
+logger = logging.getLogger("llmgraph")
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+class RequestTrace:
+    """Trace of one sampled request (or batch); detail is True when node events are logged."""
+
+    __slots__ = ("tracer", "request_id", "detail", "start")
+
+    def __init__(self, tracer: "Tracer", request_id: str, detail: bool):
+        self.tracer = tracer
+        self.request_id = request_id
+        self.detail = detail
+        self.start = time.perf_counter()
+
+    def node(self, node, event: str, **fields):
+        if self.detail:
+            self.tracer.emit(logging.DEBUG, event, request=self.request_id, node=node.id, type=node.type, **fields)
+
+    def info(self, event: str, **fields):
+        fields.setdefault("ms", round((time.perf_counter() - self.start) * 1000, 2))
+        self.tracer.emit(logging.INFO, event, request=self.request_id, **fields)
+
+
+class Tracer:
+    def __init__(self, level: str = "INFO", sample_rate: float = 1.0, max_chars: int = 200,
+                 full: bool = False, fmt: str = "text", stream=None):
+        self.handler = None
+        self.options = {}
+        self.configure(level, sample_rate, max_chars, full, fmt, stream)
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        return cls(level=os.environ.get("LLMGRAPH_TRACE_LEVEL", "INFO"),
+                   sample_rate=float(os.environ.get("LLMGRAPH_TRACE_SAMPLE_RATE", "1")),
+                   max_chars=int(os.environ.get("LLMGRAPH_TRACE_MAX_CHARS", "200")),
+                   full=_env_flag("LLMGRAPH_TRACE_FULL"),
+                   fmt=os.environ.get("LLMGRAPH_TRACE_FORMAT", "text"))
+
+    def configure(self, level: str = None, sample_rate: float = None, max_chars: int = None,
+                  full: bool = None, fmt: str = None, stream=None):
+        # Options left as None keep their current value
+        given = dict(level=level, sample_rate=sample_rate, max_chars=max_chars, full=full, fmt=fmt, stream=stream)
+        options = dict(self.options, **{k: v for k, v in given.items() if v is not None})
+        if not 0 <= options['sample_rate'] <= 1:
+            raise ValueError(f"Trace sample rate must be between 0 and 1, got {options['sample_rate']}")
+        if options['fmt'] not in ("text", "json"):
+            raise ValueError(f"Unknown trace format '{options['fmt']}'")
+        level_no = logging.getLevelName(options['level'].upper())
+        if not isinstance(level_no, int):
+            raise ValueError(f"Unknown trace level '{options['level']}'")
+        self.options = options
+        self.full = options['full']
+        self.level = logging.DEBUG if self.full else level_no
+        self.sample_rate = 1.0 if self.full else options['sample_rate']
+        self.max_chars = None if self.full else options['max_chars']
+        self.fmt = options['fmt']
+        logger.setLevel(self.level)
+        if self.handler is not None:
+            logger.removeHandler(self.handler)
+        self.handler = logging.StreamHandler(options.get('stream') or sys.stdout)
+        self.handler.setFormatter(logging.Formatter(
+            "%(message)s" if self.fmt == "json" else "%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(self.handler)
+        logger.propagate = False
+
+    def start(self) -> Optional[RequestTrace]:
+        # Sampling is decided once per request so a traced request is traced completely
+        if not logger.isEnabledFor(logging.INFO) or random.random() >= self.sample_rate:
+            return None
+        return RequestTrace(self, os.urandom(4).hex(), logger.isEnabledFor(logging.DEBUG))
+
+    def truncate(self, value) -> str:
+        text = value if isinstance(value, str) else str(value)
+        if self.max_chars is None or len(text) <= self.max_chars:
+            return text
+        return f"{text[:self.max_chars]}... [{len(text)} chars]"
+
+    def emit(self, level: int, event: str, **fields):
+        if not logger.isEnabledFor(level):
+            return
+        fields = {k: v if isinstance(v, (int, float, bool)) or v is None else self.truncate(v)
+                  for k, v in fields.items()}
+        if self.fmt == "json":
+            message = json.dumps({"ts": time.time(), "level": logging.getLevelName(level), "event": event, **fields})
+        else:
+            message = event + "".join(f" {k}={v!r}" for k, v in fields.items())
+        logger.log(level, message)
+
+
+tracer = Tracer.from_env()
+
+
+def configure(**options):
+    """Reconfigure the module tracer, e.g. configure(level="DEBUG", sample_rate=0.01)."""
+    tracer.configure(**options)